@@ -3,8 +3,11 @@ import asyncio
 from fastapi import FastAPI
 from starlette.responses import RedirectResponse
 
-from app.api.routers import b3_router, login  # health,
+from app.api.routers import b3_router, ir, login  # health,
+from app.jobs import darf_jobs
+from app.scheduler import sync_scheduler
 from b3 import B3_client
+from calc.pool import calc_pool
 from db import DB_client
 from log import get_logger
 
@@ -13,6 +16,7 @@ log = get_logger("uvicorn.error")
 app = FastAPI()
 app.include_router(login.router)
 app.include_router(b3_router.router)
+app.include_router(ir.router)
 # app.include_router(health.router)
 
 
@@ -21,12 +25,18 @@ async def startup():
     log.info("Starting up application ...")
     await B3_client.start()
     await DB_client.start()
+    calc_pool.start()
+    await sync_scheduler.start()
+    await darf_jobs.start()
     log.info("Application successfully started")
 
 
 @app.on_event("shutdown")
 async def shutdown():
     log.info("Shutting down application ...")
+    await sync_scheduler.stop()
+    await darf_jobs.stop()
+    calc_pool.stop()
     await B3_client.stop()
     await DB_client.stop()
     log.info("Applcation successfully stopped")
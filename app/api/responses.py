@@ -0,0 +1,81 @@
+import hashlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+import orjson
+import pandas as pd
+from fastapi.responses import Response
+
+from app.sync import df_to_movements_dict
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# responses are per user and change whenever movements are synced: revalidate every time
+CACHE_CONTROL = "private, no-cache"
+
+
+class RawJSONResponse(Response):
+    """JSON response of an already encoded body, skipping the response model validation."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content)
+
+
+def encode_movements(document: str, market_type: str, df: pd.DataFrame) -> bytes:
+    """Encode normalized movements as a `MovementsGrouped` JSON body."""
+    return orjson.dumps(
+        dict(document=document, market_type=market_type, movements=df_to_movements_dict(df))
+    )
+
+
+async def encode_movements_ndjson(
+    document: str, market_type: str, chunks: AsyncIterator[pd.DataFrame]
+) -> AsyncIterator[bytes]:
+    """Encode chunks of normalized movements as NDJSON, one `Movements` line per day."""
+    async for df in chunks:
+        for year, year_data in df_to_movements_dict(df).items():
+            for month, month_data in year_data.items():
+                for day, movements in month_data.items():
+                    yield orjson.dumps(
+                        dict(
+                            document=document,
+                            market_type=market_type,
+                            year=year,
+                            month=month,
+                            day=day,
+                            movements=movements,
+                        )
+                    ) + b"\n"
+
+
+def make_etag(*parts: str) -> str:
+    """Strong ETag of a representation identified by its parts."""
+    return '"' + hashlib.blake2b(":".join(parts).encode(), digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an ``If-None-Match`` header matches the ETag, by weak comparison."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+
+def freshness_headers(synced_at: Optional[datetime], stale: bool) -> Dict[str, str]:
+    """Tell whether B3 may have newer movements than the response, and when they were synced."""
+    headers = {"X-Freshness": "stale" if stale else "fresh"}
+    if synced_at is not None:
+        headers["X-Synced-At"] = synced_at.isoformat()
+    return headers
+
+
+def not_modified(etag: str, headers: Dict[str, str] = None) -> Response:
+    return Response(status_code=304, headers={**cache_headers(etag), **(headers or {})})
@@ -1,11 +1,25 @@
-from datetime import date, datetime, timedelta
-from typing import Dict, List
+import math
+from datetime import date
+from typing import AsyncIterator
 
+import orjson
 import pandas as pd
-from fastapi import APIRouter, Depends, Query, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Header, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from app.models import Message, UnauthorizedMessage, Movements, MovementsGrouped, User
+from app import sync
+from app.api.responses import (
+    NDJSON_MEDIA_TYPE,
+    RawJSONResponse,
+    cache_headers,
+    encode_movements,
+    encode_movements_ndjson,
+    etag_matches,
+    freshness_headers,
+    make_etag,
+    not_modified,
+)
+from app.models import Message, UnauthorizedMessage, MovementsGrouped, SyncMeta, User
 from app.security import get_api_user
 from b3 import B3_TIME_EDGE, MARKET_TYPE, B3_client
 from b3.models import B3AuthUrl
@@ -13,7 +27,7 @@ from config import cfg
 from db import DB_client
 from log import get_logger
 from app.exceptions import DatabaseException
-from b3.exceptions import MovementsException, UnauthorizedClientAccess
+from b3.exceptions import B3Unavailable, MovementsException, UnauthorizedClientAccess
 
 log = get_logger(__name__)
 
@@ -49,12 +63,17 @@ async def authorize(user: User = Depends(get_api_user)):
 @router.get(
     "/movements",
     summary="Get the user movements.",
-    description="Return a JSON with the movements.",
+    description=(
+        "Return a JSON with the movements. With `Accept: application/x-ndjson` or `stream=true`"
+        " the movements are streamed as NDJSON instead, one line per day, oldest first."
+    ),
     tags=["B3"],
     responses={
         500: dict(model=Message, description="Internal Error."),
         401: dict(model=Message, description="Unauthorized to access B3 API on participants\' behalf."),
         400: dict(model=Message, description="Bad request."),
+        304: dict(description="Not modified since the movements with the `If-None-Match` ETag."),
+        503: dict(model=Message, description="B3 is unavailable, see `Retry-After`."),
         200: dict(
             model=MovementsGrouped,
             description="Movements for the market type and period of the user.",
@@ -94,9 +113,19 @@ async def authorize(user: User = Depends(get_api_user)):
 async def get_movements(
     user: User = Depends(get_api_user),
     market_type: str = Query(...),
-    start_date: date = Query(B3_TIME_EDGE()),
-    end_date: date = Query(date.today()),
-) -> Movements:
+    start_date: date = Query(None, description="The B3 storing edge, 18 months ago, by default."),
+    end_date: date = Query(None, description="Today by default."),
+    stream: bool = Query(False, description="Stream the movements as NDJSON, one line per day."),
+    accept: str = Header(None),
+    if_none_match: str = Header(None),
+    allow_stale: bool = Query(
+        False,
+        description=(
+            "Answer right away from the stored movements, syncing them from B3 in the background."
+            " `X-Freshness` tells whether newer movements may be on B3."
+        ),
+    ),
+) -> RawJSONResponse:
     """User movements."""
     # assert input constraints
     if market_type not in cfg.supported_markets:
@@ -104,6 +133,8 @@ async def get_movements(
             status_code=status.HTTP_404_NOT_FOUND,
             content=Message(msg="Invalid/Unsupported market type").dict(),
         )
+    start_date = start_date or B3_TIME_EDGE()
+    end_date = end_date or date.today()
     # assert start_date param
     if str(start_date) < str(B3_TIME_EDGE()):
         start_date = B3_TIME_EDGE()
@@ -121,13 +152,38 @@ async def get_movements(
             content=Message(msg="end_date is lower than start_date\'s date").dict(),
         )
 
-    # check local data available
+    if stream or NDJSON_MEDIA_TYPE in (accept or ""):
+        return StreamingResponse(
+            _stream_movements(user, market_type, str(start_date), str(end_date)),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
     try:
-        local_data: Dict[str, pd.DataFrame] = await DB_client.get_movements(
+        if allow_stale:
+            # answer from storage now, B3 is synced for the next call
+            meta: SyncMeta = await sync.get_sync_meta(user, market_type)
+            stale: bool = sync.is_stale(meta)
+            if stale:
+                sync.refresh_in_background(user, [market_type])
+        else:
+            failures = await sync.sync_markets(user, [market_type])
+            if market_type in failures:
+                raise failures[market_type]
+            meta = await DB_client.get_sync_meta(user.document, market_type)
+            stale = False
+        # the sync metadata changes on every write, answer conditional requests from it alone
+        etag: str = make_etag(
+            user.document, market_type, str(start_date), str(end_date), meta.content_hash
+        )
+        headers = {**cache_headers(etag), **freshness_headers(meta.synced_at, stale)}
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, headers)
+        movements: pd.DataFrame = await sync.get_movements(
             user,
             market_type=market_type,
             start_date=str(start_date),
             end_date=str(end_date),
+            sync=False,
         )
     except DatabaseException as e:
         log.error(
@@ -144,114 +200,68 @@ async def get_movements(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content=Message(msg="Failed to retrieve movements").dict(),
         )
-
-    # get the latest date available in local storage
-    latest_local_date: str = str(B3_TIME_EDGE())
-    if not local_data[market_type].empty:
-        latest_local_date = _get_latest_date_from_movements(local_data[market_type])
-
-    # if data is up till today, return it, otherwise we may have new data available on B3
-    external_data: pd.DataFrame = pd.DataFrame()
-    if latest_local_date < str(date.today()):
-        try:
-            external_data: pd.DataFrame = await B3_client.movements(
+    except B3Unavailable as e:
+        log.warning(
+            "B3 is unavailable, not fetching movements",
+            extra=dict(user=user.document, market_type=market_type, retry_after=e.retry_after),
+        )
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=Message(msg="B3 is unavailable, try again later").dict(),
+            headers={"Retry-After": str(math.ceil(e.retry_after or 1))},
+        )
+    except (UnauthorizedClientAccess, MovementsException) as e:
+        log.error(
+            "Failed to fetch movements from B3",
+            extra=dict(
+                error=str(e),
+                user=user.document,
                 market_type=market_type,
-                document=user.document,
-                start_date=str(
-                    datetime.strptime(latest_local_date, "%Y-%m-%d") + timedelta(1)
-                ),
-            )
-        except (UnauthorizedClientAccess, MovementsException) as e:
-            log.error(
-                "Failed to fetch movements from B3",
-                extra=dict(
-                    error=str(e),
-                    user=user.document,
-                    market_type=market_type,
-                    start_date=start_date,
-                    end_date=end_date,
-                ),
-            )
-            if isinstance(e, UnauthorizedClientAccess):
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content=UnauthorizedMessage().dict(),
-                )
-            else:
-                return JSONResponse(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    content=Message(msg="Failed to retrieve movements").dict(),
-                )
-
-    # join local data with B3 data
-    if not local_data[market_type].empty:
-        if not external_data.empty:
-            local_data[market_type] = pd.concat(
-                [local_data[market_type], external_data]
+                start_date=start_date,
+                end_date=end_date,
+            ),
+        )
+        if isinstance(e, UnauthorizedClientAccess):
+            return JSONResponse(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                content=UnauthorizedMessage().dict(),
             )
-            # store the new collected external data
-            await DB_client.set_movements(
-                movements=_dict_to_movements_list(
-                    document=user.document,
-                    market_type=market_type,
-                    movements=_df_to_movements_dict(external_data),
-                )
+        else:
+            return JSONResponse(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                content=Message(msg="Failed to retrieve movements").dict(),
             )
-    grp = MovementsGrouped(
-        document=user.document,
-        market_type=market_type,
-        movements=_df_to_movements_dict(local_data[market_type]),
-    )
-    print(f"grp: \n{grp}\n")
-    return grp
 
-
-#---------------- helpers ----------------
-def _get_latest_date_from_movements(df: pd.DataFrame) -> str:
-    return "-".join(
-        str(df.index.get_level_values(idx).max()).zfill(2) for idx in df.index.names
+    # movements were validated when synced, encode them without building the pydantic models
+    return RawJSONResponse(
+        content=encode_movements(user.document, market_type, movements), headers=headers
     )
 
-def _dict_to_movements_list(
-    document: str, market_type: str, movements: dict
-) -> List[Movements]:
-    return [
-        Movements(
-            document=document,
-            market_type=market_type,
-            year=year,
-            month=month,
-            day=day,
-            movements=mvmts,
-        )
-        for year, year_data in movements.items()
-        for month, month_data in year_data.items()
-        for day, mvmts in month_data.items()
-    ]
 
-def _df_to_movements_dict(df: pd.DataFrame) -> dict:
-    """Will convert a pandas DataFrame with movements data to a nested dict of `Movements`."""
-    df.reset_index(inplace=True)
-    df["year"] = df.year.apply(str)
-    df["month"] = df.month.apply(str).str.zfill(2)
-    df["day"] = df.day.apply(str).str.zfill(2)
-    print(f"new df:\n{df.to_string()}\n")
-    di = (
-        df.groupby("year")
-        .apply(
-            lambda year: dict(
-                year.groupby("month").apply(
-                    lambda month: dict(
-                        month.groupby("day").apply(
-                            lambda day: day.drop(
-                                list(df.index.names), axis=1, errors="ignore"
-                            ).to_dict("records")
-                        )
-                    )
-                )
-            )
+async def _stream_movements(
+    user: User, market_type: str, start_date: str, end_date: str
+) -> AsyncIterator[bytes]:
+    """Stream the movements as NDJSON, ending with a `Message` line if they fail midway."""
+    try:
+        async for line in encode_movements_ndjson(
+            user.document,
+            market_type,
+            sync.iter_movements(user, market_type, start_date, end_date),
+        ):
+            yield line
+    except (DatabaseException, B3Unavailable, UnauthorizedClientAccess, MovementsException) as e:
+        log.error(
+            "Failed to stream movements",
+            extra=dict(
+                error=str(e),
+                user=user.document,
+                market_type=market_type,
+                start_date=start_date,
+                end_date=end_date,
+            ),
         )
-        .to_dict(into=dict)
-    )
-    print(f"df: {di}")
-    return di
+        if isinstance(e, UnauthorizedClientAccess):
+            msg: Message = UnauthorizedMessage()
+        else:
+            msg = Message(msg="Failed to retrieve movements")
+        yield orjson.dumps(msg.dict()) + b"\n"
@@ -1,12 +1,24 @@
-from typing import List
-from fastapi import APIRouter, Depends, Query, status
+import asyncio
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, Path, Query, Response, status
 from fastapi.responses import JSONResponse
 from datetime import date
-from app.models import Message, User
+from app import sync
+from app.api.responses import (
+    cache_headers,
+    etag_matches,
+    freshness_headers,
+    make_etag,
+    not_modified,
+)
+from app.exceptions import JobQueueFull
+from app.jobs import darf_jobs
+from app.models import DarfExport, DarfJob, Message, User
 from app.security import get_api_user
+from db import DB_client
 from log import get_logger
 from config import cfg
-from calc import generate_darf
+from calc import darf_input_hash, generate_darf
 
 log = get_logger(__name__)
 
@@ -15,15 +27,19 @@ router = APIRouter()
 
 @router.get(
     "/darf",
-    response_model=Darf,
+    response_model=DarfExport,
     summary="Return the darf data.",
     description="Return a JSON with the darf data.",
     responses={
         500: dict(model=Message, description="Internal Error."),
         404: dict(model=Message, description="The item was not found."),
+        304: dict(description="Not modified since the darf with the `If-None-Match` ETag."),
         200: dict(
-            model=Darf,
-            description="Darf for the market types and period.",
+            model=DarfExport,
+            description=(
+                "Darf for the market types and period. `X-Freshness: stale` when some market"
+                " failed to sync from B3 and was computed from the stored movements."
+            ),
             content={
                 "application/json": {
                     "example": {
@@ -39,12 +55,113 @@ router = APIRouter()
     },
 )
 async def darf(
+    response: Response,
     user: User = Depends(get_api_user),
     markets: List[str] = Query(...),
     year: int = Query(...),
     month: int = Query(...),
+    if_none_match: str = Header(None),
 ):
     """Generate darf."""
+    invalid = _validate_darf_params(markets, year, month)
+    if invalid is not None:
+        return invalid
+    try:
+        failures = await sync.sync_markets(user, markets)
+        for market, failure in failures.items():
+            log.error(
+                "Failed to sync movements for darf",
+                extra=dict(error=str(failure), user=user.document, market_type=market),
+            )
+        # markets that failed to sync are computed from the stored movements, flagged stale
+        metas = await asyncio.gather(
+            *(DB_client.get_sync_meta(user.document, market) for market in markets)
+        )
+        synced_at = [meta.synced_at for meta in metas]
+        headers = freshness_headers(
+            None if None in synced_at else min(synced_at), stale=bool(failures)
+        )
+        # the darf only changes with the movements of its markets
+        etag: str = make_etag(await darf_input_hash(user.document, markets, year, month))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, headers)
+        darf_export = await generate_darf(
+            markets=markets, year=year, month=month, user=user, sync=False
+        )
+    except Exception:
+        msg = "Failed to generate darf"
+        log.exception(msg)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content=Message(msg=msg).dict(),
+        )
+    response.headers.update({**cache_headers(etag), **headers})
+    return darf_export
+
+
+@router.post(
+    "/darf/jobs",
+    response_model=DarfJob,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Start generating the darf.",
+    description="Queue the darf to be generated in the background, poll it by the job id.",
+    responses={
+        503: dict(model=Message, description="Too many darfs being generated."),
+        500: dict(model=Message, description="Internal Error."),
+        404: dict(model=Message, description="The item was not found."),
+        202: dict(model=DarfJob, description="Darf job queued, running or already done."),
+    },
+)
+async def submit_darf_job(
+    user: User = Depends(get_api_user),
+    markets: List[str] = Query(...),
+    year: int = Query(...),
+    month: int = Query(...),
+):
+    """Submit a darf job."""
+    invalid = _validate_darf_params(markets, year, month)
+    if invalid is not None:
+        return invalid
+    try:
+        return await darf_jobs.submit(user, markets, year, month)
+    except JobQueueFull as e:
+        log.warning("Refusing darf job", extra=dict(error=str(e), user=user.document))
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=Message(msg="Too many darfs being generated, try again later").dict(),
+            headers={"Retry-After": "10"},
+        )
+    except Exception:
+        msg = "Failed to submit darf job"
+        log.exception(msg)
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content=Message(msg=msg).dict(),
+        )
+
+
+@router.get(
+    "/darf/jobs/{job_id}",
+    response_model=DarfJob,
+    summary="Return a darf job.",
+    description="Return the status of a darf job, and the darf once done.",
+    responses={
+        404: dict(model=Message, description="The job was not found."),
+        200: dict(model=DarfJob, description="Darf job."),
+    },
+)
+async def get_darf_job(user: User = Depends(get_api_user), job_id: str = Path(...)):
+    """Get a darf job."""
+    job: Optional[DarfJob] = await darf_jobs.get(job_id)
+    if job is None or job.document != user.document:
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content=Message(msg="Darf job not found").dict(),
+        )
+    return job
+
+
+def _validate_darf_params(markets: List[str], year: int, month: int) -> Optional[JSONResponse]:
     # assert input constraints
     if not set(markets).issubset(cfg.supported_markets):
         return JSONResponse(
@@ -63,7 +180,4 @@ async def darf(
             status_code=status.HTTP_400_BAD_REQUEST,
             content=Message(msg="Invalid month passed").dict(),
         )
-    try:
-        return await generate_darf(markets=markets, year=year, month=month, user=user)
-    except Exception as e:
-        log.exception(e)
\ No newline at end of file
+    return None
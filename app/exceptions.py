@@ -18,3 +18,11 @@ class ConnectionError(RFBaseException):
 
 class DatabaseException(RFBaseException):
     pass
+
+
+class JobQueueFull(RFBaseException):
+    pass
+
+
+class DarfIncomplete(RFBaseException):
+    pass
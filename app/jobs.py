@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import sync
+from app.exceptions import JobQueueFull
+from app.models import DarfJob, User
+from calc import Darf, darf_input_hash
+from config import cfg
+from log import get_logger
+
+log = get_logger(__name__)
+
+# (document, markets, year, month, input hash)
+JobKey = Tuple[str, Tuple[str, ...], int, int, str]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS darf_jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner INTEGER NOT NULL,
+    expires_at REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS darf_jobs_key ON darf_jobs (key);
+CREATE INDEX IF NOT EXISTS darf_jobs_expires_at ON darf_jobs (expires_at);
+"""
+
+
+class DarfJobs:
+    """Compute DARFs in the background, polled by job id.
+
+    The markets are synced when the job is submitted. A job is identified by its user, markets
+    and month, and by the hash of their stored movements: submitting a job already queued,
+    running or done for the same movements returns it instead of computing it again, and new
+    movements make a new job. Finished jobs are kept
+    ``result_ttl`` seconds, at most ``max_results`` of them.
+
+    Jobs are kept in the SQLite file at ``path``, shared by the workers of the host: any of them
+    serves and deduplicates any job. A job runs on the worker that accepted it, and fails if
+    that worker stops before finishing it.
+    """
+
+    def __init__(
+        self,
+        path: str = ".data/darf-jobs.sqlite",
+        workers: int = 2,
+        max_queue: int = 256,
+        result_ttl: float = 3600,
+        max_results: int = 4096,
+    ):
+        self._path: str = path
+        self._workers: int = workers
+        self._max_queue: int = max_queue
+        self._result_ttl: float = result_ttl
+        self._max_results: int = max_results
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.done: int = 0
+        self.failed: int = 0
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "DarfJobs":
+        return cls(**(config or {}))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            queued=self._queue.qsize() if self._queue is not None else 0,
+            done=self.done,
+            failed=self.failed,
+        )
+
+    async def start(self) -> None:
+        if not self._tasks:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="darf-jobs")
+            await self._run(self._connect)
+            self._queue = asyncio.Queue(maxsize=self._max_queue)
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self._workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+            self._executor.shutdown()
+
+    async def submit(self, user: User, markets: List[str], year: int, month: int) -> DarfJob:
+        """Queue the DARF of a month, or return the job computing or computed it already.
+
+        :raises JobQueueFull: too many jobs waiting
+        """
+        if self._queue.full():
+            raise JobQueueFull(f"{self._queue.qsize()} darf jobs waiting")
+        # hashed after syncing, as movements B3 published since change the darf
+        failures = await sync.sync_markets(user, markets)
+        for market, failure in failures.items():
+            log.error(
+                "Failed to sync movements for darf job",
+                extra=dict(error=str(failure), user=user.document, market_type=market),
+            )
+        input_hash: str = await darf_input_hash(user.document, markets, year, month)
+        key: JobKey = (user.document, tuple(sorted(set(markets))), year, month, input_hash)
+        job = DarfJob(
+            id=uuid.uuid4().hex,
+            document=user.document,
+            year=year,
+            month=month,
+            markets=list(key[1]),
+            status="queued",
+            created_at=datetime.now(),
+        )
+        found: Optional[DarfJob] = await self._run(self._insert, json.dumps(key), job)
+        if found is not None:
+            return found
+        try:
+            self._queue.put_nowait((job, user))
+        except asyncio.QueueFull:
+            await self._run(self._delete, job.id)
+            raise JobQueueFull(f"{self._queue.qsize()} darf jobs waiting")
+        return job
+
+    async def get(self, job_id: str) -> Optional[DarfJob]:
+        return await self._run(self._select, job_id)
+
+    async def _work(self) -> None:
+        while True:
+            job, user = await self._queue.get()
+            job.status = "running"
+            try:
+                await self._run(self._update, job)
+                darf = Darf(
+                    markets=job.markets, year=job.year, month=job.month, user=user, sync=False
+                )
+                await darf.calculate()
+                if darf.failures:
+                    job.status = "failed"
+                    job.error = "; ".join(f"{mkt}: {e}" for mkt, e in darf.failures.items())
+                    self.failed += 1
+                else:
+                    job.result = darf.export()
+                    job.status = "done"
+                    self.done += 1
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                self.failed += 1
+                log.exception(
+                    "Failed to generate darf", extra=dict(user=user.document, job=job.id)
+                )
+            finally:
+                job.finished_at = datetime.now()
+                try:
+                    await self._run(self._update, job)
+                except Exception:
+                    log.exception("Failed to store darf job", extra=dict(job=job.id))
+                self._queue.task_done()
+
+    #---------------- storage ----------------
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self) -> None:
+        Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        # autocommit, transactions are begun explicitly
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _insert(self, key: str, job: DarfJob) -> Optional[DarfJob]:
+        """Store the new job, unless a job of the key queued, running or done is found."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "DELETE FROM darf_jobs WHERE expires_at < ?"
+                " OR id IN (SELECT id FROM darf_jobs WHERE expires_at IS NOT NULL"
+                " ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (now, self._max_results),
+            )
+            for data, owner in self._conn.execute(
+                "SELECT data, owner FROM darf_jobs WHERE key = ? AND status != 'failed'", (key,)
+            ).fetchall():
+                found = _load(data, owner)
+                if found.status != "failed":
+                    self._conn.execute("COMMIT")
+                    return found
+                found.finished_at = datetime.now()
+                self._update(found)
+            self._conn.execute(
+                "INSERT INTO darf_jobs (id, key, status, owner, expires_at, data)"
+                " VALUES (?, ?, ?, ?, NULL, ?)",
+                (job.id, key, job.status, os.getpid(), job.json()),
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def _update(self, job: DarfJob) -> None:
+        expires_at = time.time() + self._result_ttl if job.finished_at is not None else None
+        self._conn.execute(
+            "UPDATE darf_jobs SET status = ?, expires_at = ?, data = ? WHERE id = ?",
+            (job.status, expires_at, job.json(), job.id),
+        )
+
+    def _delete(self, job_id: str) -> None:
+        self._conn.execute("DELETE FROM darf_jobs WHERE id = ?", (job_id,))
+
+    def _select(self, job_id: str) -> Optional[DarfJob]:
+        row = self._conn.execute(
+            "SELECT data, owner FROM darf_jobs WHERE id = ?"
+            " AND (expires_at IS NULL OR expires_at >= ?)",
+            (job_id, time.time()),
+        ).fetchone()
+        return _load(*row) if row else None
+
+
+def _load(data: str, owner: int) -> DarfJob:
+    """Parse a stored job, failed if the worker running it is gone."""
+    job = DarfJob.parse_raw(data)
+    if job.finished_at is None and not _is_alive(owner):
+        job.status = "failed"
+        job.error = "the worker running the job stopped"
+    return job
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+darf_jobs = DarfJobs.from_config(cfg.darf_jobs)
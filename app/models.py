@@ -45,13 +45,38 @@ class Movements(RFModel):
     year: str
     month: str
     day: str
-    movements: List[Movement]
+    movements: List[Dict[str, Any]]  # `EquitiesMovement` records in wire format
 
     @property
     def path(self):
         return f"{self.document}/{self.market_type}/{self.year}/{self.month.zfill(2)}/{self.day.zfill(2)}"
 
 
+class StoredDigest(RFModel):
+    digest: str  # of the stored movements, in any order
+    rows: int
+
+
+class SyncMeta(RFModel):
+    """What is stored of a user's market movements, readable without loading them."""
+
+    document: str
+    market_type: str
+    last_date: Optional[str] = None  # date of the latest stored movement
+    synced_at: Optional[datetime] = None  # last successful sync from B3
+    last_active: Optional[datetime] = None  # last request of the user syncing it, roughly
+    rows: int = 0
+    content_hash: str = ""  # of all the stored movements, "" if none
+    snapshots_until: Optional[str] = None  # last month (YYYY-MM) with a valid month-end snapshot
+    months: Dict[str, StoredDigest] = {}  # YYYY-MM -> what is stored of the month
+    version: int = 0  # of the stored record, bumped by every update
+
+    @property
+    def first_date(self) -> Optional[str]:
+        """First day of the month of the earliest stored movement."""
+        return f"{min(self.months)}-01" if self.months else None
+
+
 class MovementsGrouped(RFModel):
     document: str
     market_type: str
@@ -85,3 +110,16 @@ class DarfExport(RFModel):
     value: str
     markets: List[str]  # B3::MARKET_TYPE
     url: str
+
+
+class DarfJob(RFModel):
+    id: str
+    document: str
+    year: int
+    month: int
+    markets: List[str]
+    status: str  # queued | running | done | failed
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    result: Optional[DarfExport] = None
+    error: Optional[str] = None
@@ -0,0 +1,160 @@
+import asyncio
+import fcntl
+import itertools
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, Any, Dict, List, Optional
+
+from app import sync
+from app.models import SyncMeta, User
+from config import cfg
+from db import DB_client
+from log import get_logger
+
+log = get_logger(__name__)
+
+
+class SyncScheduler:
+    """Sync the movements of subscribed users from B3 after its daily update.
+
+    Every run queues each market of every subscribed user, the most recently active users
+    first, and syncs them incrementally from their stored watermark with a pool of
+    ``workers``. B3 calls stay under the B3 client rate limit. Markets already synced after the
+    last B3 update are skipped, so a run interrupted by a restart resumes where it stopped.
+
+    Only one process runs the syncs: the one holding the lock on ``lock_path``, the others try
+    to take it over every ``leader_retry`` seconds. The leader records every completed run in
+    the lock file, and only runs at start up if the run of the last B3 update is missing.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        workers: int = 4,
+        lock_path: str = ".data/sync-scheduler.lock",
+        leader_retry: float = 60,
+    ):
+        self._enabled: bool = enabled
+        self._workers: int = workers
+        self._lock_path = Path(lock_path)
+        self._leader_retry: float = leader_retry
+        self._lock: Optional[IO] = None
+        self._task: Optional[asyncio.Task] = None
+        self.synced: int = 0
+        self.failed: int = 0
+        self.last_run: Optional[datetime] = None
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "SyncScheduler":
+        return cls(**(config or {}))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            leader=self._lock is not None,
+            synced=self.synced,
+            failed=self.failed,
+            last_run=self.last_run,
+        )
+
+    async def start(self) -> None:
+        if self._enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock is not None:
+            self._lock.close()  # releases the lock
+            self._lock = None
+
+    async def run_once(self) -> None:
+        """Sync every market of every subscribed user once."""
+        users: List[User] = await DB_client.get_subscribed_users()
+        markets = [(user, mkt_type) for user in users for mkt_type in cfg.supported_markets]
+        slots = asyncio.Semaphore(self._workers)
+
+        async def get_sync_meta(user: User, market_type: str) -> SyncMeta:
+            async with slots:
+                return await DB_client.get_sync_meta(user.document, market_type)
+
+        # the last activity is recorded in the sync metadata by whichever worker served it
+        metas = await asyncio.gather(
+            *(get_sync_meta(user, mkt_type) for user, mkt_type in markets),
+            return_exceptions=True,
+        )
+        queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        seq = itertools.count()  # keeps the order stable among users equally active
+        for (user, market_type), meta in zip(markets, metas):
+            active = sync.last_active(meta) if isinstance(meta, SyncMeta) else 0.0
+            queue.put_nowait((-active, next(seq), user, market_type))
+        log.info("Starting movements sync", extra=dict(users=len(users), markets=queue.qsize()))
+        workers = [asyncio.ensure_future(self._work(queue)) for _ in range(self._workers)]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        self.last_run = datetime.now()
+        if self._lock is not None:
+            self._lock.seek(0)
+            self._lock.truncate()
+            self._lock.write(self.last_run.isoformat())
+            self._lock.flush()
+        log.info("Finished movements sync", extra=self.stats)
+
+    async def _run(self) -> None:
+        while not self._lead():
+            await asyncio.sleep(self._leader_retry)
+        log.info("Leading the movements sync", extra=dict(last_run=self.last_run))
+        while True:
+            if self.last_run is None or self.last_run < sync.last_b3_update():
+                try:
+                    await self.run_once()
+                except Exception:
+                    log.exception("Got an exception when syncing movements")
+            next_update = sync.last_b3_update() + timedelta(days=1)
+            await asyncio.sleep(max((next_update - datetime.now()).total_seconds(), 0))
+
+    def _lead(self) -> bool:
+        """Take the lock of the leader, reading the last completed run off it."""
+        self._lock_path.parent.mkdir(parents=True, exist_ok=True)
+        lock = open(self._lock_path, "a+")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        lock.seek(0)
+        try:
+            self.last_run = datetime.fromisoformat(lock.read().strip())
+        except ValueError:  # no run completed yet
+            self.last_run = None
+        self._lock = lock
+        return True
+
+    async def _work(self, queue: asyncio.PriorityQueue) -> None:
+        while True:
+            _, _, user, market_type = await queue.get()
+            try:
+                failures = await sync.sync_markets(user, [market_type], background=True)
+                if market_type in failures:
+                    raise failures[market_type]
+                self.synced += 1
+            except Exception as e:
+                self.failed += 1
+                log.error(
+                    "Failed to sync movements",
+                    extra=dict(error=str(e), user=user.document, market_type=market_type),
+                )
+            finally:
+                queue.task_done()
+
+
+sync_scheduler = SyncScheduler.from_config(cfg.sync_scheduler)
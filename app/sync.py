@@ -0,0 +1,351 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from app.models import Movements, SyncMeta, User
+from b3 import B3_HISTORY_START, B3_TIME_EDGE, B3_client
+from b3.normalize import concat_movements, denormalize_movements
+from config import cfg
+from db import DB_client
+from log import get_logger
+from utils import SingleFlight
+
+log = get_logger(__name__)
+
+_sync_flight = SingleFlight()
+# how outdated the last activity of a user market may be before it's recorded again
+ACTIVITY_RESOLUTION = timedelta(hours=1)
+# (document, market_type) -> background refresh in progress
+_refreshes: Dict[Tuple[str, str], asyncio.Future] = {}
+
+
+async def get_movements(
+    user: User, market_type: str, start_date: str, end_date: str, sync: bool = True
+) -> pd.DataFrame:
+    """Get the user movements of a market type, syncing new movements from B3 first.
+
+    :raises DatabaseException: failed to read or write the local movements
+    :raises UnauthorizedClientAccess: RF is not authorized to access B3 on user's behalf
+    :raises MovementsException: failed to fetch movements from B3
+    """
+    movements, failures = await get_movements_many(
+        user, market_types=[market_type], start_date=start_date, end_date=end_date, sync=sync
+    )
+    if market_type in failures:
+        raise failures[market_type]
+    return movements[market_type]
+
+
+async def get_movements_many(
+    user: User,
+    market_types: List[str],
+    start_date: str,
+    end_date: str,
+    sync: bool = True,
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, Exception]]:
+    """Get the user movements of several market types at once, syncing each from B3.
+
+    The markets are synced first (see `sync_markets`) and then read, along with the movements
+    just synced.
+
+    :param sync: whether to sync the markets first, False if the caller already did
+    :returns: the movements per market type, and the exception per market type that failed
+    """
+    failures: Dict[str, Exception] = await sync_markets(user, market_types) if sync else {}
+    local_data, read_failures = await DB_client.get_movements_many(
+        user,
+        market_types=[mkt_type for mkt_type in market_types if mkt_type not in failures],
+        start_date=start_date,
+        end_date=end_date,
+    )
+    failures.update(read_failures)
+    return local_data, failures
+
+
+async def sync_markets(
+    user: User, market_types: List[str], background: bool = False
+) -> Dict[str, Exception]:
+    """Sync the user markets that may have new movements on B3, concurrently.
+
+    Whether a market has new data on B3 is told by its sync metadata, without loading its
+    movements: markets synced after B3's last daily update are skipped. B3 pages are bounded by
+    the per-client budget of the B3 client, so a user with many markets does not starve the
+    others.
+
+    :param background: synced by the scheduler, not on behalf of a user request
+    :returns: the exception per market type that failed
+    """
+    failures: Dict[str, Exception] = {}
+    metas = await asyncio.gather(
+        *(get_sync_meta(user, mkt_type) for mkt_type in market_types), return_exceptions=True
+    )
+    if not background:
+        await _record_activity(user, [meta for meta in metas if isinstance(meta, SyncMeta)])
+    to_sync: Dict[str, str] = {}
+    for mkt_type, meta in zip(market_types, metas):
+        if isinstance(meta, Exception):
+            failures[mkt_type] = meta
+            continue
+        sync_start = _get_sync_start_date(meta)
+        if sync_start is not None:
+            to_sync[mkt_type] = sync_start
+
+    results = await asyncio.gather(
+        *(
+            sync_movements(document=user.document, market_type=mkt_type, start_date=start)
+            for mkt_type, start in to_sync.items()
+        ),
+        return_exceptions=True,
+    )
+    for mkt_type, result in zip(to_sync, results):
+        if isinstance(result, Exception):
+            failures[mkt_type] = result
+    return failures
+
+
+def refresh_in_background(user: User, market_types: List[str]) -> None:
+    """Sync the user markets without waiting, one refresh at a time per user market."""
+    for mkt_type in market_types:
+        key = (user.document, mkt_type)
+        if key not in _refreshes:
+            _refreshes[key] = asyncio.ensure_future(_refresh(user, mkt_type))
+            _refreshes[key].add_done_callback(lambda _, key=key: _refreshes.pop(key, None))
+
+
+def is_stale(meta: SyncMeta) -> bool:
+    """Whether B3 may have movements newer than the stored ones."""
+    return _get_sync_start_date(meta) is not None
+
+
+def last_active(meta: SyncMeta) -> float:
+    """Timestamp of the last request that synced the user market, 0 if none."""
+    return meta.last_active.timestamp() if meta.last_active is not None else 0.0
+
+
+def last_b3_update(now: datetime = None) -> datetime:
+    """When B3 last published movements, at `b3_daily_update_at` every day."""
+    now = now or datetime.now()
+    at: str = cfg.b3_daily_update_at or "07:00"
+    update = datetime.combine(now.date(), datetime.strptime(at, "%H:%M").time())
+    return update if update <= now else update - timedelta(days=1)
+
+
+async def iter_movements(
+    user: User, market_type: str, start_date: str, end_date: str
+) -> AsyncIterator[pd.DataFrame]:
+    """Yield the user movements of a market type month by month, then the newly synced ones.
+
+    Only a month of the local history is held at a time; the new movements from B3 are synced
+    once the local ones have been streamed, and yielded page by page as they are stored. When
+    another request is syncing the same movements already, they are yielded at once when it
+    is done instead.
+
+    :raises DatabaseException: failed to read or write the local movements
+    :raises UnauthorizedClientAccess: RF is not authorized to access B3 on user's behalf
+    :raises MovementsException: failed to fetch movements from B3
+    """
+    sync_start = _get_sync_start_date(await get_sync_meta(user, market_type))
+    async for df in DB_client.iter_movements(user, market_type, start_date, end_date):
+        if not df.empty:
+            yield df
+    if sync_start is None:
+        return
+    key = (user.document, market_type, sync_start)
+    flight = _sync_flight.in_flight(key)
+    # another request syncing the same movements already is waited for, not fetched twice,
+    # and requests arriving while this one syncs them wait for it the same way
+    chunks: AsyncIterator[pd.DataFrame] = (
+        _await_flight(flight)
+        if flight is not None
+        else _iter_shared_movements(user.document, market_type, sync_start)
+    )
+    async for chunk in chunks:
+        chunk = chunk[(chunk.reference_date >= start_date) & (chunk.reference_date <= end_date)]
+        if not chunk.empty:
+            yield chunk
+
+
+async def _refresh(user: User, market_type: str) -> None:
+    failures = await sync_markets(user, [market_type])
+    if market_type in failures:
+        log.error(
+            "Failed to refresh movements in the background",
+            extra=dict(
+                error=str(failures[market_type]), user=user.document, market_type=market_type
+            ),
+        )
+
+
+async def get_sync_meta(user: User, market_type: str) -> SyncMeta:
+    """Get the sync metadata of a user market.
+
+    :raises DatabaseException: failed to read the local movements
+    """
+    meta: SyncMeta = await DB_client.get_sync_meta(user.document, market_type)
+    if not meta.months and (meta.rows or (meta.last_date is None and meta.synced_at is None)):
+        # movements stored before the sync metadata tracked them, index them once: all of them,
+        # stored while older ones were still within the B3 storing edge included
+        df = (
+            await DB_client.get_movements(
+                user, str(B3_HISTORY_START), str(date.today()), market_type=market_type
+            )
+        )[market_type]
+        if not df.empty:
+            meta = await DB_client.index_movements(
+                user.document,
+                market_type,
+                dict_to_movements_list(user.document, market_type, df_to_movements_dict(df)),
+            )
+    return meta
+
+
+async def sync_movements(document: str, market_type: str, start_date: str) -> pd.DataFrame:
+    """Fetch the new movements from B3 and store them.
+
+    Concurrent syncs of the same client, market and start date share one fetch and one write.
+    """
+    return await _sync_flight.do(
+        (document, market_type, start_date),
+        _fetch_and_store_movements,
+        document,
+        market_type,
+        start_date,
+    )
+
+
+async def _fetch_and_store_movements(
+    document: str, market_type: str, start_date: str, pages: Optional[asyncio.Queue] = None
+) -> pd.DataFrame:
+    """Fetch the new movements from B3, storing each page of movements as it lands.
+
+    :param pages: queue to put each page in once stored, then None once done
+    """
+    chunks: List[pd.DataFrame] = []
+    try:
+        async for chunk in _iter_and_store_movements(document, market_type, start_date):
+            chunks.append(chunk)
+            if pages is not None:
+                pages.put_nowait(chunk)
+    finally:
+        if pages is not None:
+            pages.put_nowait(None)
+    return concat_movements(chunks)
+
+
+async def _iter_and_store_movements(
+    document: str, market_type: str, start_date: str
+) -> AsyncIterator[pd.DataFrame]:
+    """Yield the new movements from B3 page by page, once each page is stored."""
+    async for chunk in B3_client.iter_movement_pages(
+        market_type=market_type, document=document, start_date=start_date
+    ):
+        await DB_client.set_movements(
+            movements=dict_to_movements_list(
+                document=document,
+                market_type=market_type,
+                movements=df_to_movements_dict(chunk),
+            )
+        )
+        yield chunk
+    await DB_client.mark_synced(document, market_type)
+
+
+async def _iter_shared_movements(
+    document: str, market_type: str, start_date: str
+) -> AsyncIterator[pd.DataFrame]:
+    """Yield the new movements from B3 page by page, syncing them as `sync_movements` does.
+
+    The sync is the in-flight call of the movements until all pages are stored, and keeps
+    going if the caller stops iterating.
+    """
+    pages: asyncio.Queue = asyncio.Queue()
+    flight = _sync_flight.start(
+        (document, market_type, start_date),
+        _fetch_and_store_movements,
+        document,
+        market_type,
+        start_date,
+        pages,
+    )
+    while True:
+        page: Optional[pd.DataFrame] = await pages.get()
+        if page is None:
+            break
+        yield page
+    await asyncio.shield(flight)  # raises what failed the sync
+
+
+#---------------- helpers ----------------
+async def _record_activity(user: User, metas: List[SyncMeta]) -> None:
+    """Store when the user markets were last requested, shared with the scheduler leader."""
+    outdated = datetime.now() - ACTIVITY_RESOLUTION
+    results = await asyncio.gather(
+        *(
+            DB_client.mark_active(user.document, meta.market_type)
+            for meta in metas
+            if meta.last_active is None or meta.last_active < outdated
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            log.error(
+                "Failed to record the user activity",
+                extra=dict(error=str(result), user=user.document),
+            )
+
+
+async def _await_flight(flight: asyncio.Future) -> AsyncIterator[pd.DataFrame]:
+    yield await asyncio.shield(flight)
+
+
+def _get_sync_start_date(meta: SyncMeta) -> Optional[str]:
+    """Return the date to sync B3 movements from, or None if nothing new can be on B3."""
+    if meta.synced_at is not None and meta.synced_at >= last_b3_update():
+        return None
+    latest_local_date: str = meta.last_date or str(B3_TIME_EDGE())
+    if latest_local_date >= str(date.today()):
+        return None
+    return str((datetime.strptime(latest_local_date, "%Y-%m-%d") + timedelta(1)).date())
+
+
+def dict_to_movements_list(
+    document: str, market_type: str, movements: dict
+) -> List[Movements]:
+    return [
+        Movements(
+            document=document,
+            market_type=market_type,
+            year=year,
+            month=month,
+            day=day,
+            movements=mvmts,
+        )
+        for year, year_data in movements.items()
+        for month, month_data in year_data.items()
+        for day, mvmts in month_data.items()
+    ]
+
+
+def df_to_movements_dict(df: pd.DataFrame) -> dict:
+    """Convert normalized movements to a year → month → day dict of wire format records.
+
+    The frame is sorted once by date and walked in a single pass, keeping the order of the
+    movements within each day.
+    """
+    if df.empty:
+        return {}
+    df = denormalize_movements(df.sort_values("reference_date", kind="stable"))
+    grouped: Dict[str, Dict[str, Dict[str, List[dict]]]] = {}
+    last_day, day_movements = None, None
+    for record in df.to_dict("records"):
+        day: str = record["reference_date"]
+        if day != last_day:
+            day_movements = (
+                grouped.setdefault(day[:4], {}).setdefault(day[5:7], {}).setdefault(day[8:], [])
+            )
+            last_day = day
+        day_movements.append(record)
+    return grouped
@@ -9,5 +9,6 @@ from .enums import MARKET_TYPE
 B3_TIME_EDGE: date = lambda: date.today() - timedelta(
     days=558
 )  # 18 months ago is the B3 storing edge
+B3_HISTORY_START: date = date(2019, 1, 1)  # older than any movement B3 ever served
 
 B3_client = B3(config=cfg.b3)
@@ -4,9 +4,10 @@ import os
 import pathlib
 import posixpath
 import ssl
-from collections import OrderedDict
-from datetime import date
-from typing import Any, Collection, Dict, List, OrderedDict, Union
+import weakref
+from collections import OrderedDict, deque
+from datetime import date, timedelta
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, OrderedDict, Tuple
 from urllib.parse import urlencode
 
 import aiohttp
@@ -14,20 +15,34 @@ import certifi
 import pandas as pd
 from aiohttp import ClientSession
 
-from app.models import EquitiesMovement, Movement
 from log import get_logger
+from utils import SingleFlight
 
 from .exceptions import (
+    B3BaseException,
+    B3Unavailable,
     InconsistentPaginatorData,
     MovementsException,
     PaginatorException,
     RequestException,
     TokenException,
+    TooManyRequests,
     B3ResponseException,
     UnauthorizedClientAccess,
     raise_for_status
 )
+from .auth import TokenManager
+from .enums import MARKET_TYPE
 from .models import B3Credentials, Token
+from .normalize import concat_movements, normalize_movements
+from .throttle import (
+    AdmissionController,
+    CircuitBreaker,
+    Permit,
+    TokenBucket,
+    backoff_delay,
+    parse_retry_after,
+)
 
 API_VERSION: str = "v2"
 ROOT_DIR = pathlib.Path.cwd()
@@ -43,13 +58,30 @@ class B3:
         """Initialise the class."""
         self._loop = loop or asyncio.get_event_loop()
         self._auth = B3Credentials(**config.get("auth"))
-        self._token: Token = None
         self._token_url: str = config.get("token_url")
         self._token_scope: str = config.get("token_scope")
         self._base_url: str = config.get("base_url")
         self._auth_url: str = config.get("auth_url")
         self._api_path: Dict[str, str] = config.get("api_path")
         self._session: ClientSession = None
+        # paginator throttling
+        paginator_cfg: Dict[str, Any] = config.get("paginator") or {}
+        self._max_concurrency: int = paginator_cfg.get("max_concurrency", 4)
+        self._max_retries: int = paginator_cfg.get("max_retries", 5)
+        self._backoff_base: float = paginator_cfg.get("backoff_base", 0.5)
+        self._backoff_max: float = paginator_cfg.get("backoff_max", 30)
+        self._max_buffered_pages: int = paginator_cfg.get("max_buffered_pages", 8)
+        self._range_window_days: int = paginator_cfg.get("range_window_days", 31)
+        self._max_parallel_windows: int = paginator_cfg.get("max_parallel_windows", 6)
+        self._client_slots: Dict[str, asyncio.Semaphore] = weakref.WeakValueDictionary()
+        self._limiter: TokenBucket = TokenBucket.from_config(config.get("rate_limit"))
+        self._breaker: CircuitBreaker = CircuitBreaker.from_config(config.get("circuit_breaker"))
+        self._admission = AdmissionController.from_config(config.get("admission"))
+        self._pending_pages: int = 0
+        self._movements_flight = SingleFlight()
+        self._tokens = TokenManager(
+            fetch=self._get_token, refresh_margin=config.get("token_refresh_margin", 300)
+        )
 
     @property
     def is_started(self):
@@ -62,9 +94,10 @@ class B3:
             self._session = ClientSession(
                 loop=self._loop, connector=_get_ssl_connector()
             )
-        await self._get_token()
+        await self._tokens.get()
 
     async def stop(self) -> None:
+        self._tokens.stop()
         if self.is_started:
             if not self._session.closed:
                 await self._session.close()
@@ -72,6 +105,17 @@ class B3:
     async def health() -> None:
         ...
 
+    @property
+    def throttle_stats(self) -> Dict[str, Any]:
+        """Current state of the paginator throttling."""
+        return dict(
+            rate=self._limiter.rate,
+            queue_depth=self._pending_pages,
+            rate_limiter_queue_depth=self._limiter.queue_depth,
+            circuit=self._breaker.state,
+            admission=self._admission.stats,
+        )
+
     async def authorize(self) -> str:
         """Authorize RF to use B3 APIs on behalf of one's account.
 
@@ -79,7 +123,7 @@ class B3:
         """
         return self._auth_url
 
-    async def _get_token(self) -> None:
+    async def _get_token(self) -> Token:
         """Require oauth 2.0 token from B3 to execute API calls."""
         try:
             data: str = urlencode(
@@ -92,9 +136,9 @@ class B3:
             )
             headers = {"Content-Type": "application/x-www-form-urlencoded"}
             resp = await self._request(
-                method="POST", url=self._token_url, data=data, headers=headers
+                method="POST", url=self._token_url, data=data, headers=headers, auth=False
             )
-            self._token = Token(**resp)
+            return Token(**resp)
         except Exception as e:
             log.exception(
                 "Got an exception when fetching B3 access token",
@@ -107,45 +151,116 @@ class B3:
         market_type: str,
         document: str,
         start_date: str = None,
-        end_date: str = str(date.today()),
+        end_date: str = None,
     ) -> pd.DataFrame:
-        try:
-            path: OrderedDict[str, Any] = OrderedDict(
-                endpoint="movement",
-                version=API_VERSION,
+        """Fetch the movements of a client in a date range, up to today by default.
+
+        Concurrent identical calls share one upstream fetch, and a call whose range is covered
+        by a fetch already in flight for the same client and market is served from it. The
+        returned DataFrame may be shared between callers and must not be mutated in place.
+        """
+        market_type = MARKET_TYPE(market_type).value
+        end_date = end_date or str(date.today())
+        key = (document, market_type, start_date, end_date)
+        covering: asyncio.Future = self._covering_movements_flight(key)
+        if covering is not None and self._movements_flight.in_flight(key) is None:
+            return _slice_by_date(await asyncio.shield(covering), start_date, end_date)
+        return await self._movements_flight.do(key, self._fetch_movements, *key)
+
+    async def movements_many(
+        self,
+        document: str,
+        market_types: List[str],
+        start_date: str = None,
+        end_date: str = None,
+    ) -> Tuple[Dict[str, pd.DataFrame], Dict[str, B3BaseException]]:
+        """Fetch the movements of a client for several market types at once, up to today by default.
+
+        All markets share the client's page budget (``paginator.max_concurrency``), so fanning
+        out over many markets does not multiply the load put on B3 for a single user.
+
+        :returns: the movements per market type, and the exception per market type that failed
+        """
+        results = await asyncio.gather(
+            *(
+                self.movements(
+                    market_type=mkt_type,
+                    document=document,
+                    start_date=start_date,
+                    end_date=end_date,
+                )
+                for mkt_type in market_types
+            ),
+            return_exceptions=True,
+        )
+        movements: Dict[str, pd.DataFrame] = {}
+        failures: Dict[str, B3BaseException] = {}
+        for mkt_type, result in zip(market_types, results):
+            if isinstance(result, Exception):
+                failures[mkt_type] = result
+            else:
+                movements[mkt_type] = result
+        return movements, failures
+
+    def _covering_movements_flight(self, key: Tuple[str, str, str, str]) -> asyncio.Future:
+        """Return an in-flight fetch whose date range covers the key's, if any."""
+        document, market_type, start_date, end_date = key
+        for flight_key in self._movements_flight.keys():
+            doc, mkt, start, end = flight_key
+            if (
+                doc == document
+                and mkt == market_type
+                and (start is None or (start_date is not None and start <= start_date))
+                and end >= end_date
+            ):
+                return self._movements_flight.in_flight(flight_key)
+        return None
+
+    async def _fetch_movements(
+        self, document: str, market_type: str, start_date: str, end_date: str
+    ) -> pd.DataFrame:
+        chunks: List[pd.DataFrame] = [
+            chunk
+            async for chunk in self.iter_movement_pages(
                 market_type=market_type,
-                investors="investors",
                 document=document,
+                start_date=start_date,
+                end_date=end_date,
             )
-            params: Dict[str, Any] = dict(
-                referenceStartDate=start_date, referenceEndDate=end_date
-            )
-            movements: List[dict] = []
-            pages = await self._paginator(method="GET", path=path, params=params)
-
-            for p in pages:
-                if not "data" in p:
-                    raise_for_status(p['code'])
-                    raise InconsistentPaginatorData(page=p)
-                movements.extend(
-                    p["data"][f'{path["market_type"].value}Periods'][
-                        f'{path["market_type"].value}Movements'
-                    ]
-                )
+        ]
+        return concat_movements(chunks)
 
-            df = pd.DataFrame(pages)
-            df.rename(
-                columns=dict(
-                    list(zip(df.columns.values.tolist(), EquitiesMovement.attrs))
-                )
+    async def iter_movement_pages(
+        self,
+        market_type: str,
+        document: str,
+        start_date: str = None,
+        end_date: str = None,
+    ) -> AsyncIterator[pd.DataFrame]:
+        """Yield the movements as normalized DataFrame chunks, page by page, up to today by default.
+
+        Long date ranges are split in windows of ``range_window_days`` which are fetched
+        concurrently and yielded in date order. Pages are fetched ahead concurrently but
+        yielded in page order, and the movements of a day spanning two pages are held back so
+        every chunk holds whole days only.
+        """
+        try:
+            market_type = MARKET_TYPE(market_type).value
+            end_date = end_date or str(date.today())
+            windows: List[Tuple[str, str]] = (
+                _split_date_range(start_date, end_date, self._range_window_days)
+                if start_date
+                else [(start_date, end_date)]
             )
-            df["year"] = df.reference_date.apply(lambda d: int(d.split("-")[0]))
-            df["month"] = df.reference_date.apply(lambda d: int(d.split("-")[1]))
-            df["day"] = df.reference_date.apply(lambda d: int(d.split("-")[2]))
-            df.set_index(["year", "month", "day"], inplace=True)
-            return df
+            # the windows don't overlap, equal movements are distinct trades and all kept
+            async for chunk in self._iter_windows(market_type, document, windows):
+                yield chunk
 
         except Exception as e:
+            unavailable = _get_cause(e, B3Unavailable)
+            if unavailable is not None:
+                log.warning("Skipped fetching B3 movements, B3 is unavailable")
+                raise unavailable
             if isinstance(e, InconsistentPaginatorData):
                 log.error('Received inconsistent paginator data', extra=dict(error=str(e), page=e.page))
             elif isinstance(e, B3ResponseException):
@@ -157,7 +272,6 @@ class B3:
                     "Got an exception when fetching B3 movements",
                     extra=dict(
                         error=str(e),
-                        path=path,
                         market_type=market_type,
                         document=document,
                         start_date=start_date,
@@ -166,11 +280,95 @@ class B3:
                 )
             raise MovementsException from e
 
+    async def _iter_windows(
+        self, market_type: str, document: str, windows: List[Tuple[str, str]]
+    ) -> AsyncIterator[pd.DataFrame]:
+        """Fetch up to ``max_parallel_windows`` date windows at once, yielding in window order."""
+        if len(windows) == 1:
+            async for chunk in self._iter_window(market_type, document, *windows[0]):
+                yield chunk
+            return
+
+        async def fill(queue: asyncio.Queue, start_date: str, end_date: str) -> None:
+            try:
+                async for chunk in self._iter_window(market_type, document, start_date, end_date):
+                    await queue.put(chunk)
+                await queue.put(None)
+            except Exception as e:
+                await queue.put(e)
+
+        remaining = iter(windows)
+        pending: Deque[Tuple[asyncio.Queue, asyncio.Future]] = deque()
+        # the window being consumed, out of `pending`; its filler may be blocked on a full queue
+        current: Optional[asyncio.Future] = None
+        try:
+            while True:
+                while len(pending) < self._max_parallel_windows:
+                    window = next(remaining, None)
+                    if window is None:
+                        break
+                    queue = asyncio.Queue(maxsize=self._max_buffered_pages)
+                    pending.append((queue, asyncio.ensure_future(fill(queue, *window))))
+                if not pending:
+                    return
+                queue, current = pending.popleft()
+                while True:
+                    chunk = await queue.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+        finally:
+            if current is not None:
+                current.cancel()
+            for _, task in pending:
+                task.cancel()
+
+    async def _iter_window(
+        self, market_type: str, document: str, start_date: str, end_date: str
+    ) -> AsyncIterator[pd.DataFrame]:
+        path: OrderedDict[str, Any] = OrderedDict(
+            endpoint="movement",
+            version=API_VERSION,
+            market_type=market_type,
+            investors="investors",
+            document=document,
+        )
+        params: Dict[str, Any] = dict(
+            referenceStartDate=start_date, referenceEndDate=end_date
+        )
+        carry: pd.DataFrame = None
+        async for page in self._iter_pages(method="GET", path=path, params=params):
+            df = _page_to_df(page, market_type)
+            if carry is not None:
+                df = pd.concat([carry, df], ignore_index=True)
+            if df.empty:
+                continue
+            last_day = df.referenceDate == df.referenceDate.iloc[-1]
+            carry = df[last_day]
+            if not last_day.all():
+                yield normalize_movements(df[~last_day])
+        if carry is not None and not carry.empty:
+            yield normalize_movements(carry)
+
     async def _request(
-        self, *, method, url=None, data=None, path=None, params=None, headers=None
+        self,
+        *,
+        method,
+        url=None,
+        data=None,
+        path=None,
+        params=None,
+        headers=None,
+        auth=True,
     ) -> Dict:
         """Perform a request to the B3 API.
 
+        A request rejected with 401 refreshes the access token and is retried once. While the B3
+        API is failing the circuit breaker rejects authenticated requests without calling it.
+
+        :raises B3Unavailable: the circuit breaker is open
         :raises RequestException: got a request exception
         """
         if not self.is_started:
@@ -184,81 +382,201 @@ class B3:
             if isinstance(data, str)
             else None
         )
-        headers = (
-            {"Authorization": f"{self._token.token_type} {self._token.access_token}"}
-            if self._token
-            else headers
-        )
 
+        # taken right before the try clause, whose finally clause always hands the permit back
+        breaker: Optional[CircuitBreaker] = self._breaker if auth else None
+        permit: Optional[Permit] = breaker.allow() if breaker is not None else None
+        if breaker is not None and permit is None:
+            raise B3Unavailable(retry_after=breaker.retry_after)
+        healthy: Optional[bool] = None
         try:
-            async with self._session.request(
-                method, url, data=data, params=params, headers=headers
-            ) as resp:
-                # data = body, params = query
+            for retry_unauthorized in (auth, False):
+                token: Token = await self._tokens.get() if auth else None
+                req_headers = (
+                    {"Authorization": f"{token.token_type} {token.access_token}"}
+                    if token
+                    else headers
+                )
                 try:
-                    ret = await resp.json()
-                except:
-                    ret = dict(
-                        code=resp.status, message=await resp.text() or "no message"
+                    async with self._session.request(
+                        method, url, data=data, params=params, headers=req_headers
+                    ) as resp:
+                        healthy = resp.status < 500
+                        # data = body, params = query
+                        try:
+                            ret = await resp.json()
+                        except:
+                            ret = dict(
+                                code=resp.status, message=await resp.text() or "no message"
+                            )
+                        if resp.status == 401 and retry_unauthorized:
+                            log.info("B3 rejected the access token, refreshing it")
+                            await self._tokens.refresh(stale=token)
+                            continue
+                        if resp.status == 429:
+                            raise TooManyRequests(
+                                retry_after=parse_retry_after(resp.headers.get("Retry-After"))
+                            )
+                        if resp.status != 200:
+                            log.warning(f"Received bad status", extra=dict(response=ret))
+                        return ret
+                except TooManyRequests:
+                    raise
+                except Exception as e:
+                    healthy = False
+                    log.exception(
+                        f"Got a request exception",
+                        extra=dict(
+                            method=method, url=url, data=data, params=params, headers=req_headers
+                        ),
                     )
-                if resp.status != 200:
-                    log.warning(f"Received bad status", extra=dict(response=ret))
-                return ret
-        except Exception as e:
-            log.exception(
-                f"Got a request exception",
-                extra=dict(
-                    method=method, url=url, data=data, params=params, headers=headers
-                ),
-            )
-            raise RequestException from e
+                    raise RequestException from e
+        finally:
+            if breaker is not None:
+                breaker.record(permit, healthy)
 
     async def _paginator(
-        self, *, method, data=None, path=None, params={}
+        self, *, method, data=None, path=None, params=None
     ) -> List[Dict]:
         """Perform parallel requests to the B3 API, fetching all pages of a request.
 
         :raises PaginatorException: failed to paginate
         """
+        return [
+            page
+            async for page in self._iter_pages(
+                method=method, data=data, path=path, params=params
+            )
+        ]
+
+    async def _iter_pages(
+        self, *, method, data=None, path=None, params=None
+    ) -> AsyncIterator[Dict]:
+        """Yield all pages of a request in page order, fetching the next ones concurrently.
+
+        At most ``max_buffered_pages`` pages are in flight or awaiting consumption, which caps
+        the memory held per request. Requests are also bounded per client (the investor
+        document), admitted by the process-wide admission controller, paced by the adaptive
+        rate limiter and retried with backoff when B3 throttles us.
+
+        :raises PaginatorException: failed to paginate
+        """
+        pending: Deque[asyncio.Future] = deque()
         try:
-            page_param: Dict[str, int] = lambda pg: dict(page=pg)  # noqa
-            params.update(page_param(1))
             fixed_kw: OrderedDict[str, Any] = OrderedDict(
                 method=method, data=data, path=os.path.join(*path.values())
             )
-            resp = await self._request(**fixed_kw, params=params)
+            params = dict(params or {})
+            client: str = path.get("document")
+            client_slots = self._client_slots.setdefault(
+                client, asyncio.Semaphore(self._max_concurrency)
+            )
+            fetch_page = lambda pg: self._fetch_page(  # noqa
+                fixed_kw, dict(params, page=pg), client, client_slots
+            )
+            resp = await fetch_page(1)
+            yield resp
 
             if not "links" in resp:
-                return [resp]
-
-            pages_total: int = resp["links"]["last"].split("=")[-1]
-            pending: Collection[asyncio.Future] = [
-                self._request(
-                    **fixed_kw, params=params.update(page_param(pg)) or params
-                )
-                for pg in range(1, pages_total + 1)
-            ]
+                return
 
-            pages = List[Union[str, dict]]
-
-            while pending:
-                done, pending = asyncio.wait(
-                    pending, return_when=asyncio.FIRST_COMPLETED
-                )
-                for d in done:
-                    pages.append(d.result())
-
-            return pages
+            pages_total: int = int(resp["links"]["last"].split("=")[-1])
+            next_page: int = 2
+            while next_page <= pages_total or pending:
+                while next_page <= pages_total and len(pending) < self._max_buffered_pages:
+                    pending.append(asyncio.ensure_future(fetch_page(next_page)))
+                    next_page += 1
+                yield await pending.popleft()
         except Exception as e:
             log.exception(
                 "Got an exception in paginator",
-                extra=dict(**fixed_kw, params=params),
+                extra=dict(method=method, path=path, params=params),
             )
             raise PaginatorException from e
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    async def _fetch_page(
+        self,
+        fixed_kw: Dict[str, Any],
+        params: Dict[str, Any],
+        client: str,
+        client_slots: asyncio.Semaphore,
+    ) -> Dict:
+        """Fetch a single page, retrying with jittered exponential backoff on 429.
+
+        :raises TooManyRequests: still throttled after all retries
+        :raises B3Overloaded: shed by the admission controller
+        """
+        self._pending_pages += 1
+        try:
+            for attempt in range(self._max_retries + 1):
+                async with client_slots, self._admission.slot(client):
+                    await self._limiter.acquire()
+                    try:
+                        resp = await self._request(**fixed_kw, params=params)
+                    except TooManyRequests as e:
+                        self._limiter.on_throttle()
+                        if attempt == self._max_retries:
+                            raise e
+                        delay = backoff_delay(
+                            attempt, self._backoff_base, self._backoff_max, e.retry_after
+                        )
+                    else:
+                        self._limiter.on_success()
+                        return resp
+                # back off without holding a concurrency slot
+                log.info(
+                    "Retrying throttled B3 page",
+                    extra=dict(attempt=attempt + 1, delay=delay, params=params),
+                )
+                await asyncio.sleep(delay)
+        finally:
+            self._pending_pages -= 1
 
 def _get_ssl_connector() -> aiohttp.TCPConnector:
     ssl_ctx = ssl.create_default_context(
         ssl.Purpose.CLIENT_AUTH, cafile=certifi.where()
     )
     ssl_ctx.load_cert_chain(CERT_PATH, KEY_PATH, CERT_PW)
-    return aiohttp.TCPConnector(ssl=ssl_ctx)
\ No newline at end of file
+    return aiohttp.TCPConnector(ssl=ssl_ctx)
+
+
+def _page_to_df(page: Dict, market_type: str) -> pd.DataFrame:
+    """Extract the raw movements of a B3 page into a DataFrame."""
+    if not "data" in page:
+        raise_for_status(page['code'])
+        raise InconsistentPaginatorData(page=page)
+    return pd.DataFrame(page["data"][f"{market_type}Periods"][f"{market_type}Movements"])
+
+
+def _get_cause(e: BaseException, exc_type: type) -> Optional[BaseException]:
+    """Return the exception, or the first in its chain of causes, of the given type."""
+    while e is not None:
+        if isinstance(e, exc_type):
+            return e
+        e = e.__cause__
+    return None
+
+
+def _slice_by_date(df: pd.DataFrame, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    if df.empty:
+        return df
+    mask = pd.Series(True, index=df.index)
+    if start_date is not None:
+        mask &= df.reference_date >= start_date
+    if end_date is not None:
+        mask &= df.reference_date <= end_date
+    return df[mask.values]
+
+
+def _split_date_range(start_date: str, end_date: str, days: int) -> List[Tuple[str, str]]:
+    """Split an inclusive ISO date range in consecutive windows of at most `days` days."""
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    windows: List[Tuple[str, str]] = []
+    while start <= end:
+        window_end = min(end, start + timedelta(days=days - 1))
+        windows.append((str(start), str(window_end)))
+        start = window_end + timedelta(days=1)
+    return windows or [(start_date, end_date)]
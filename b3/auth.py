@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+from log import get_logger
+from utils import SingleFlight
+
+from .models import Token
+
+log = get_logger(__name__)
+
+
+class TokenManager:
+    """Cache the B3 OAuth token and refresh it ahead of its expiry.
+
+    Concurrent callers share a single in-flight refresh, and a background task renews the
+    token ``refresh_margin`` seconds before it expires so callers never wait on it.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Awaitable[Token]],
+        refresh_margin: float = 300,
+        retry_delay: float = 5,
+    ):
+        self._fetch = fetch
+        self._refresh_margin: float = refresh_margin
+        self._retry_delay: float = retry_delay
+        self._token: Optional[Token] = None
+        self._expires_at: float = 0.0
+        self._flight = SingleFlight()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def token(self) -> Optional[Token]:
+        return self._token
+
+    @property
+    def is_valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at
+
+    async def get(self) -> Token:
+        """Return a valid token, fetching one if there is none yet or it has expired."""
+        if self.is_valid:
+            return self._token
+        return await self.refresh()
+
+    async def refresh(self, stale: Token = None) -> Token:
+        """Refresh the token, joining the refresh already in flight if any.
+
+        :param stale: the token that was rejected; if it was already replaced the current
+            token is returned without refreshing again.
+        """
+        if stale is not None and self._token is not stale and self.is_valid:
+            return self._token
+        return await self._flight.do("token", self._refresh)
+
+    def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def _refresh(self) -> Token:
+        token: Token = await self._fetch()
+        self._token = token
+        self._expires_at = time.monotonic() + token.expires_in
+        margin: float = min(self._refresh_margin, token.expires_in / 2)
+        self._schedule(max(1.0, token.expires_in - margin))
+        return token
+
+    def _schedule(self, delay: float) -> None:
+        self.stop()
+        self._refresh_task = asyncio.ensure_future(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._refresh_task = None
+        try:
+            await self._flight.do("token", self._refresh)
+        except Exception:
+            log.exception(
+                "Failed to proactively refresh B3 access token",
+                extra=dict(retry_in=self._retry_delay),
+            )
+            self._schedule(self._retry_delay)
@@ -31,6 +31,18 @@ class AuthException(B3BaseException):
     ...
 
 
+class B3Unavailable(B3BaseException):
+    """B3 is considered unhealthy, upstream calls are skipped for ``retry_after`` seconds."""
+
+    def __init__(self, retry_after: float = None):
+        self.retry_after = retry_after
+        super().__init__()
+
+
+class B3Overloaded(B3Unavailable):
+    """Too many B3 requests are queued in the process, the request was shed."""
+
+
 class InconsistentPaginatorData(B3BaseException):
     def __init__(self, page: dict):
         self.page = page
@@ -49,7 +61,9 @@ class UnknownStatusReceived(B3ResponseException):
 
 
 class TooManyRequests(B3ResponseException):
-    ...
+    def __init__(self, retry_after: float = None):
+        self.retry_after = retry_after
+        super().__init__()
 
 
 def raise_for_status(status: str):
@@ -0,0 +1,125 @@
+from typing import Dict, List
+
+import pandas as pd
+
+# B3 API field -> movement column
+B3_COLUMNS: Dict[str, str] = dict(
+    referenceDate="reference_date",
+    productCategoryName="product_category",
+    productTypeName="product_type_name",
+    movementType="movement_type",
+    operationType="operation_type",
+    tickerSymbol="ticker_symbol",
+    corporationName="corporation_name",
+    participantName="participant_name",
+    participantDocumentNumber="participant_document_number",
+    equitiesQuantity="equities_quantity",
+    unitPrice="unit_price",
+    operationValue="operation_value",
+)
+INDEX_NAMES: List[str] = ["year", "month", "day"]
+# amounts are stored as integer cents
+AMOUNT_SCALE: int = 100
+AMOUNT_COLUMNS: List[str] = ["operation_value"]
+# prices may have more decimals, they are stored as integers of 10^-8 of the currency unit
+PRICE_COLUMNS: List[str] = ["unit_price"]
+PRICE_DECIMALS: int = 8
+PRICE_SCALE: int = 10 ** PRICE_DECIMALS
+QUANTITY_COLUMNS: List[str] = ["equities_quantity"]
+CATEGORY_COLUMNS: List[str] = [
+    "product_category",
+    "product_type_name",
+    "movement_type",
+    "operation_type",
+    "ticker_symbol",
+    "corporation_name",
+    "participant_name",
+    "participant_document_number",
+]
+
+
+def normalize_movements(df: pd.DataFrame) -> pd.DataFrame:
+    """Turn raw movement records, from B3 or from storage, into typed compact columns.
+
+    Dates are parsed once into datetime64, amounts become integer cents and prices integers
+    of `PRICE_SCALE`, repeated text becomes categorical and the frame is indexed by
+    (year, month, day).
+    """
+    if df.empty:
+        return pd.DataFrame()
+    df = df.rename(columns=B3_COLUMNS)
+    dates = pd.to_datetime(df.reference_date, format="%Y-%m-%d")
+    df = df.assign(reference_date=dates)
+    for col in AMOUNT_COLUMNS:
+        if col in df:
+            df[col] = (
+                pd.to_numeric(df[col], errors="coerce").mul(AMOUNT_SCALE).round().astype("Int64")
+            )
+    for col in PRICE_COLUMNS:
+        if col in df:
+            df[col] = (
+                pd.to_numeric(df[col], errors="coerce").mul(PRICE_SCALE).round().astype("Int64")
+            )
+    for col in QUANTITY_COLUMNS:
+        if col in df:
+            df[col] = pd.to_numeric(df[col], errors="coerce", downcast="integer")
+    for col in CATEGORY_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype("category")
+    df.index = pd.MultiIndex.from_arrays(
+        [dates.dt.year.values, dates.dt.month.values, dates.dt.day.values], names=INDEX_NAMES
+    )
+    return df
+
+
+def concat_movements(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate normalized frames, keeping repeated text categorical."""
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    df = pd.concat(frames)
+    for col in CATEGORY_COLUMNS:
+        if col in df and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def denormalize_movements(df: pd.DataFrame) -> pd.DataFrame:
+    """Render a normalized frame back into the wire format of `EquitiesMovement`."""
+    if df.empty:
+        return df
+    df = df.assign(reference_date=df.reference_date.dt.strftime("%Y-%m-%d"))
+    for col in AMOUNT_COLUMNS:
+        if col in df:
+            df[col] = format_amounts(df[col])
+    for col in PRICE_COLUMNS:
+        if col in df:
+            df[col] = format_prices(df[col])
+    for col in CATEGORY_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype(object)
+    return df
+
+
+def format_amounts(cents: pd.Series) -> pd.Series:
+    """Format integer cents as the decimal strings B3 uses, e.g. 790 -> "7.90"."""
+    return _format_fixed(cents, AMOUNT_SCALE, 2)
+
+
+def format_prices(prices: pd.Series) -> pd.Series:
+    """Format integer prices as decimal strings of two or more places, e.g. "12.3456"."""
+    text = _format_fixed(prices, PRICE_SCALE, PRICE_DECIMALS)
+    return text.str.replace(r"(\.\d\d\d*?)0+$", r"\1", regex=True)
+
+
+def _format_fixed(values: pd.Series, scale: int, decimals: int) -> pd.Series:
+    absolute = values.abs()
+    text = (
+        (absolute // scale).astype(str)
+        + "."
+        + (absolute % scale).astype(str).str.zfill(decimals)
+    )
+    text = text.where(~values.lt(0).fillna(False), "-" + text)
+    return text.astype(object).where(values.notna(), None)
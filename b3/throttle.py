@@ -0,0 +1,284 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, NamedTuple, Optional
+
+from log import get_logger
+
+from .exceptions import B3Overloaded
+
+log = get_logger(__name__)
+
+
+class TokenBucket:
+    """Token bucket rate limiter whose rate adapts to upstream throttling.
+
+    The rate is decreased multiplicatively whenever B3 answers with a 429 and increased
+    additively on every successful call (AIMD), bounded by ``min_rate`` and ``max_rate``.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: int = 20,
+        min_rate: float = 1.0,
+        max_rate: float = 50.0,
+        decrease_factor: float = 0.5,
+        increase_step: float = 0.5,
+    ):
+        self._rate: float = float(rate)
+        self._burst: int = int(burst)
+        self._min_rate: float = float(min_rate)
+        self._max_rate: float = float(max_rate)
+        self._decrease_factor: float = float(decrease_factor)
+        self._increase_step: float = float(increase_step)
+        self._tokens: float = float(burst)
+        self._updated_at: float = time.monotonic()
+        self._waiting: int = 0
+        self._lock: asyncio.Lock = None
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "TokenBucket":
+        return cls(**(config or {}))
+
+    @property
+    def rate(self) -> float:
+        """Current allowed requests per second."""
+        return self._rate
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of callers waiting for a token."""
+        return self._waiting
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it. Waiters are served in FIFO order."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self._waiting += 1
+        try:
+            async with self._lock:
+                self._refill()
+                while self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self._rate)
+                    self._refill()
+                self._tokens -= 1
+        finally:
+            self._waiting -= 1
+
+    def on_success(self) -> None:
+        self._rate = min(self._max_rate, self._rate + self._increase_step)
+
+    def on_throttle(self) -> None:
+        self._refill()
+        self._rate = max(self._min_rate, self._rate * self._decrease_factor)
+        self._tokens = min(self._tokens, 0.0)  # drain the burst so the new rate takes effect now
+        log.warning("B3 throttled us, decreasing request rate", extra=dict(rate=self._rate))
+
+
+class AdmissionController:
+    """Admit at most ``max_in_flight`` B3 requests in the whole process.
+
+    Requests over the limit wait in a queue per client (the investor document), and freed
+    slots are granted to the waiting clients in turn, so one client with many pages cannot
+    starve the others. Requests are shed with `B3Overloaded` when ``max_queue`` requests are
+    already waiting, or when one waited ``queue_timeout`` seconds without a slot.
+    """
+
+    def __init__(self, max_in_flight: int = 32, max_queue: int = 512, queue_timeout: float = 10.0):
+        self._max_in_flight: int = int(max_in_flight)
+        self._max_queue: int = int(max_queue)
+        self._queue_timeout: float = float(queue_timeout)
+        self._in_flight: int = 0
+        self._queued: int = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+        self._turns: Deque[str] = deque()  # clients with waiters, in round robin order
+        self.shed: int = 0
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "AdmissionController":
+        return cls(**(config or {}))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(in_flight=self._in_flight, queued=self._queued, shed=self.shed)
+
+    @asynccontextmanager
+    async def slot(self, client: str):
+        await self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, client: str) -> None:
+        """Take a slot, waiting for the client's turn if all are taken.
+
+        :raises B3Overloaded: the queue is full or the wait timed out
+        """
+        if self._in_flight < self._max_in_flight and not self._queued:
+            self._in_flight += 1
+            return
+        if self._queued >= self._max_queue:
+            self._shed(client, "queue full")
+        fut: asyncio.Future = asyncio.get_event_loop().create_future()
+        if client not in self._waiters:
+            self._waiters[client] = deque()
+            self._turns.append(client)
+        self._waiters[client].append(fut)
+        self._queued += 1
+        self._grant()
+        try:
+            await asyncio.wait_for(fut, self._queue_timeout)
+        except asyncio.TimeoutError:
+            self._shed(client, "queue timeout")
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # granted right as the caller went away
+            raise
+        finally:
+            self._queued -= 1
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._grant()
+
+    def _grant(self) -> None:
+        while self._turns and self._in_flight < self._max_in_flight:
+            client = self._turns.popleft()
+            waiters = self._waiters[client]
+            fut = waiters.popleft()
+            if waiters:
+                self._turns.append(client)
+            else:
+                del self._waiters[client]
+            if not fut.done():  # skip waiters that timed out or were cancelled
+                fut.set_result(None)
+                self._in_flight += 1
+
+    def _shed(self, client: str, reason: str) -> None:
+        self.shed += 1
+        log.warning(
+            "Shedding B3 request",
+            extra=dict(reason=reason, client=client, in_flight=self._in_flight),
+        )
+        raise B3Overloaded(retry_after=self._queue_timeout)
+
+
+class Permit(NamedTuple):
+    """A call let through by a `CircuitBreaker`, to hand back with its outcome."""
+
+    probe: bool
+    # the opening or closing of the circuit the call was let through after
+    generation: int
+
+
+class CircuitBreaker:
+    """Stop calling B3 while it is failing.
+
+    After ``failure_threshold`` consecutive failures (5xx or no response) the circuit opens and
+    calls are rejected for ``reset_timeout`` seconds. Then a single probe call is let through:
+    its success closes the circuit, its failure opens it again. The outcome of a call let
+    through before the circuit last opened or closed is ignored.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self._failure_threshold: int = int(failure_threshold)
+        self._reset_timeout: float = float(reset_timeout)
+        self._failures: int = 0
+        self._opened_at: Optional[float] = None
+        self._probing: bool = False
+        self._generation: int = 0
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "CircuitBreaker":
+        return cls(**(config or {}))
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self._reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until the circuit lets a probe call through."""
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self._reset_timeout - time.monotonic())
+
+    def allow(self) -> Optional[Permit]:
+        """The permit of a call allowed to go upstream now, None if rejected.
+
+        The first call once half open is the probe.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return Permit(probe=False, generation=self._generation)
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return Permit(probe=True, generation=self._generation)
+        return None
+
+    def record(self, permit: Permit, ok: Optional[bool]) -> None:
+        """Record the outcome of an allowed call, None if it was cancelled before one."""
+        if permit.probe:
+            self._probing = False
+        elif permit.generation != self._generation:
+            return
+        if ok is None:
+            return
+        if ok:
+            if self._opened_at is not None:
+                log.info("B3 is healthy again, closing the circuit")
+                self._generation += 1
+            self._failures, self._opened_at = 0, None
+            return
+        self._failures += 1
+        if permit.probe or (
+            self._opened_at is None and self._failures >= self._failure_threshold
+        ):
+            self._opened_at = time.monotonic()
+            self._generation += 1
+            log.warning(
+                "B3 is failing, opening the circuit",
+                extra=dict(failures=self._failures, reset_timeout=self._reset_timeout),
+            )
+
+
+def backoff_delay(
+    attempt: int, base: float, cap: float, retry_after: Optional[float] = None
+) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's ``Retry-After``."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, base)
+    return delay
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a ``Retry-After`` header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
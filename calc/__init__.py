@@ -1 +1 @@
-from .darf import Darf
\ No newline at end of file
+from .darf import Darf, darf_input_hash, generate_darf
@@ -0,0 +1,198 @@
+"""Compute the DARFs of many users and months at once, e.g. a whole year at tax season.
+
+Run ``python -m calc.batch --year 2021`` for every subscribed user, see ``--help``.
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.models import DarfExport, User
+from app.sync import sync_markets
+from b3 import B3_client
+from config import cfg
+from db import DB_client
+from log import get_logger
+
+from .darf import Darf
+from .pool import calc_pool
+
+log = get_logger(__name__)
+
+# (document, year, month)
+JobKey = Tuple[str, int, int]
+
+
+class DarfBatch:
+    """Compute the DARF of every (user, year, month) job, ``concurrency`` users at a time.
+
+    The months of a user are computed in order after syncing the user once, so each month
+    starts from the snapshot the previous one stored. The tax engines run on the `calc_pool`
+    processes. Every finished job is appended to the ``checkpoint`` JSON lines file, and jobs
+    found there are skipped: an interrupted batch resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        markets: List[str],
+        concurrency: int = 8,
+        checkpoint: Optional[str] = None,
+        sync: bool = True,
+    ):
+        self._markets: List[str] = markets
+        self._concurrency: int = concurrency
+        self._checkpoint: Optional[Path] = Path(checkpoint) if checkpoint else None
+        self._sync: bool = sync
+        self.done: int = 0
+        self.failed: int = 0
+        self.skipped: int = 0
+        self._started: float = 0.0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return dict(
+            done=self.done,
+            failed=self.failed,
+            skipped=self.skipped,
+            elapsed=round(elapsed, 1),
+            jobs_per_second=round(self.done / elapsed, 2) if elapsed else 0.0,
+        )
+
+    async def run(self, users: List[User], year: int, months: List[int]) -> Dict[str, Any]:
+        """Compute the DARFs of the users for the months of the year not computed yet.
+
+        :returns: the batch stats
+        """
+        finished: Set[JobKey] = self._read_checkpoint()
+        self._started = time.monotonic()
+        slots = asyncio.Semaphore(self._concurrency)
+
+        async def run_user(user: User):
+            pending = [m for m in months if (user.document, year, m) not in finished]
+            self.skipped += len(months) - len(pending)
+            if pending:
+                async with slots:
+                    await self._run_user(user, year, pending)
+
+        log.info(
+            "Starting darf batch",
+            extra=dict(users=len(users), year=year, months=months, markets=self._markets),
+        )
+        await asyncio.gather(*(run_user(user) for user in users))
+        log.info("Finished darf batch", extra=self.stats)
+        return self.stats
+
+    async def _run_user(self, user: User, year: int, months: List[int]) -> None:
+        failures: Dict[str, Exception] = (
+            await sync_markets(user, self._markets, background=True) if self._sync else {}
+        )
+        for market, failure in failures.items():
+            log.error(
+                "Failed to sync movements for darf batch",
+                extra=dict(error=str(failure), user=user.document, market_type=market),
+            )
+        for month in months:
+            darf = Darf(markets=self._markets, year=year, month=month, user=user, sync=False)
+            try:
+                await darf.calculate()
+                error = "; ".join(f"{mkt}: {e}" for mkt, e in darf.failures.items())
+            except Exception as e:
+                error = str(e)
+            if error:
+                self.failed += 1
+                log.error(
+                    "Failed to compute darf",
+                    extra=dict(error=error, user=user.document, year=year, month=month),
+                )
+                continue
+            self._write_checkpoint(user.document, darf.export())
+            self.done += 1
+            if self.done % 100 == 0:
+                log.info("Darf batch progress", extra=self.stats)
+
+    def _read_checkpoint(self) -> Set[JobKey]:
+        if self._checkpoint is None or not self._checkpoint.exists():
+            return set()
+        finished: Set[JobKey] = set()
+        with self._checkpoint.open() as f:
+            for line in f:
+                try:
+                    job = json.loads(line)
+                except ValueError:  # torn last line of an interrupted batch
+                    continue
+                darf = job["darf"]
+                finished.add((job["document"], int(darf["year"]), int(darf["month"])))
+        return finished
+
+    def _write_checkpoint(self, document: str, darf: DarfExport) -> None:
+        if self._checkpoint is None:
+            return
+        self._checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        with self._checkpoint.open("a") as f:
+            f.write(json.dumps(dict(document=document, darf=darf.dict())) + "\n")
+
+
+async def run_darf_batch(
+    year: int,
+    months: List[int] = None,
+    users: List[User] = None,
+    markets: List[str] = None,
+    **kw,
+) -> Dict[str, Any]:
+    """Compute the DARFs of a year, for every subscribed user by default.
+
+    Months still to come are left out. See `DarfBatch` for the other parameters.
+    """
+    months = months or list(range(1, 13))
+    today = date.today()
+    months = [m for m in months if (year, m) <= (today.year, today.month)]
+    users = users if users is not None else await DB_client.get_subscribed_users()
+    batch = DarfBatch(markets=markets or cfg.supported_markets, **kw)
+    return await batch.run(users, year, months)
+
+
+async def main(args: argparse.Namespace) -> None:
+    await DB_client.start()
+    if args.sync:
+        await B3_client.start()
+    calc_pool.start()
+    try:
+        users = None
+        if args.emails:
+            found = await asyncio.gather(*map(DB_client.get_user, args.emails))
+            users = [user for user in found if user is not None]
+        await run_darf_batch(
+            year=args.year,
+            months=args.months,
+            users=users,
+            markets=args.markets,
+            sync=args.sync,
+            **{
+                **(cfg.darf_batch or {}),
+                **({"checkpoint": args.checkpoint} if args.checkpoint else {}),
+                **({"concurrency": args.concurrency} if args.concurrency else {}),
+            },
+        )
+    finally:
+        calc_pool.stop()
+        if args.sync:
+            await B3_client.stop()
+        await DB_client.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--months", type=int, nargs="+", help="all of the year by default")
+    parser.add_argument("--emails", nargs="+", help="all subscribed users by default")
+    parser.add_argument("--markets", nargs="+", help="all supported markets by default")
+    parser.add_argument("--checkpoint", help="JSON lines file of the computed darfs")
+    parser.add_argument("--concurrency", type=int, help="users computed at once")
+    parser.add_argument(
+        "--no-sync", dest="sync", action="store_false", help="use the stored movements only"
+    )
+    asyncio.run(main(parser.parse_args()))
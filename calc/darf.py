@@ -1,39 +1,178 @@
-from re import S
-from typing import List
-from app.models import User, Movements, Movement
-from app.api.routers.b3_router import get_movements
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
 import pandas as pd
 
+from app.exceptions import DarfIncomplete, DatabaseException
+from app.models import DarfExport, SyncMeta, User
+from app.sync import get_movements, get_sync_meta, sync_markets
+from b3.normalize import AMOUNT_SCALE
+from config import cfg
+from db import DB_client
+from db.base import combine_digests
+from db.cache import TTLCache
+from log import get_logger
+
+from .pool import calc_pool
+
+log = get_logger(__name__)
+
+# bump on any change of the results of the tax engines, to drop what they computed before
+ENGINE_VERSION: int = 2
+
+# (document, markets, year, month) -> (input hash, reports)
+_results = TTLCache(**(cfg.darf_cache or {}))
+
+
 class Darf:
-    """Darf class."""
+    """Darf class.
+
+    The tax of a month depends on the whole history before it: the cost of the positions sold
+    and the losses carried. It's computed from the latest month-end snapshot before the month,
+    or else from the earliest stored movement. Movements before the first sync of the user,
+    past the B3 storing edge by then, are unknown: positions opened before it are costed at
+    their sale price.
+    """
     def __init__(
         self,
         markets: List[str],
         year: int,
         month: int,
-        user: User
+        user: User,
+        sync: bool = True,
     ):
         self.markets: List[str] = markets
         self.year: int = year
         self.month: int = month
         self.user: User = user
-    
+        self.sync: bool = sync
+        # market -> why its movements failed to sync, computed from the stored ones then
+        self.sync_failures: Dict[str, Exception] = dict()
+        # market -> why its tax could not be computed
+        self.failures: Dict[str, Exception] = dict()
+        # market -> monthly tax report, see `equities.MONTHLY_COLUMNS`
+        self.reports: Dict[str, pd.DataFrame] = dict()
+
     @property
     def start_date(self) -> str:
-        return f'{self.year}-{self.month}-01'
-    
+        return f'{self.year}-{self.month:02d}-01'
+
     @property
     def end_date(self) -> str:
-        return str(pd.Period(self.start_date, freq='M').end_time.date())
-    
+        return str(self.period.end_time.date())
+
+    @property
+    def period(self) -> pd.Period:
+        return pd.Period(self.start_date, freq='M')
+
+    @property
+    def tax(self) -> int:
+        """Tax due in the month over all markets, in cents."""
+        return int(sum(report.tax.get(self.period, 0) for report in self.reports.values()))
+
     async def calculate(self):
-        for market in self.markets:
-            mvmts: Movements = await get_movements(self.user, market_type=market, start_date=self.start_date, end_date=self.end_date)
-            getattr(self, f'_calculate_{market}')(movements=mvmts.movements)
+        """Compute the reports of every market, reusing the last ones if no input changed.
 
-    def _calculate_equities(self, mvmts: List[Movement]):
-        
+        Markets that fail to sync are computed from their stored movements.
+        """
+        self.sync_failures = await sync_markets(self.user, self.markets) if self.sync else {}
+        for market, failure in self.sync_failures.items():
+            log.error(
+                "Failed to sync movements for darf",
+                extra=dict(error=str(failure), user=self.user.document, market_type=market),
+            )
+        key = (self.user.document, tuple(sorted(set(self.markets))), self.year, self.month)
+        input_hash = await darf_input_hash(*key)
+        cached: Optional[Tuple[str, Dict[str, pd.DataFrame]]] = _results.get(key)
+        if cached is not None and cached[0] == input_hash:
+            self.reports = dict(cached[1])
+            return
+        markets = list(dict.fromkeys(self.markets))
+        results = await asyncio.gather(
+            *(getattr(self, f'_calculate_{market}')() for market in markets),
+            return_exceptions=True,
+        )
+        failures: Dict[str, Exception] = {}
+        for market, result in zip(markets, results):
+            if isinstance(result, DatabaseException):
+                failures[market] = result
+            elif isinstance(result, BaseException):
+                raise result
+        self.failures = failures
+        for market, failure in self.failures.items():
+            log.error(
+                "Failed to fetch movements for darf",
+                extra=dict(error=str(failure), user=self.user.document, market_type=market),
+            )
+        if not failures:
+            # hashed before reading: movements written meanwhile only make it miss next time
+            _results.set(key, (input_hash, dict(self.reports)))
 
+    def export(self) -> DarfExport:
+        """The DARF of the month.
+
+        :raises DarfIncomplete: the tax of some market could not be computed
+        """
+        if self.failures:
+            raise DarfIncomplete(
+                "; ".join(f"{mkt}: {e}" for mkt, e in self.failures.items())
+            )
+        return DarfExport(
+            year=str(self.year),
+            month=f'{self.month:02d}',
+            value=f'{self.tax / AMOUNT_SCALE:.2f}',
+            markets=self.markets,
+            url='',  # no DARF document is issued yet
+        )
+
+    async def _calculate_equities(self):
+        meta: SyncMeta = await get_sync_meta(self.user, 'equities')
+        since, opening = await self._opening_snapshot(meta)
+        mvmts = await get_movements(
+            self.user,
+            'equities',
+            start_date=(
+                str(since.start_time.date())
+                if since is not None
+                else min(meta.first_date or self.start_date, self.start_date)
+            ),
+            end_date=self.end_date,
+            sync=False,
+        )
+        self.reports['equities'], snapshots = await calc_pool.equities_tax(
+            mvmts, until=self.period, since=since, opening=opening
+        )
+        # without a valid opening snapshot the ones stored are rewritten from the whole history
+        await self._store_snapshots(meta, snapshots, rewrite=opening is None)
+
+    async def _opening_snapshot(
+        self, meta: SyncMeta
+    ) -> Tuple[Optional[pd.Period], Optional[dict]]:
+        """Month to start the calculation from, and the snapshot of the month before it."""
+        if meta.snapshots_until is None:
+            return None, None
+        base = min(self.period - 1, pd.Period(meta.snapshots_until, freq='M'))
+        opening = await DB_client.get_snapshot(meta.document, meta.market_type, str(base))
+        if opening is None or opening.get('engine') != ENGINE_VERSION:
+            return None, None
+        return base + 1, opening
+
+    async def _store_snapshots(
+        self, meta: SyncMeta, snapshots: Dict[str, dict], rewrite: bool = False
+    ):
+        """Persist the snapshots of the months past, new since the last calculation."""
+        current = str(pd.Period.now(freq='M'))
+        until = None if rewrite else meta.snapshots_until
+        new = {
+            month: dict(snapshot, engine=ENGINE_VERSION)
+            for month, snapshot in snapshots.items()
+            if month < current and (until is None or month > until)
+        }
+        if new:
+            await DB_client.set_snapshots(
+                meta.document, meta.market_type, new, meta.content_hash
+            )
 
 
 #---------------- helpers ----------------
@@ -41,8 +180,32 @@ async def generate_darf(
     markets: List[str],
     year: int,
     month: int,
-    user: User
+    user: User,
+    sync: bool = True,
 ):
-    darf = Darf(markets=markets, year=year, month=month, user=user)
+    darf = Darf(markets=markets, year=year, month=month, user=user, sync=sync)
     await darf.calculate()
-    return darf.export()
\ No newline at end of file
+    return darf.export()
+
+
+async def darf_input_hash(document: str, markets: List[str], year: int, month: int) -> str:
+    """Hash of what the DARF of a month depends on: the stored movements of its markets.
+
+    Only movements up to the end of the month count, combined from the per month hashes of the
+    sync metadata without loading them, so syncing newer movements keeps the hash of past
+    months. It changes with `ENGINE_VERSION` too.
+    """
+    metas: List[SyncMeta] = await asyncio.gather(
+        *(DB_client.get_sync_meta(document, market) for market in sorted(set(markets)))
+    )
+    until = f"{year}-{month:02d}"
+    parts = [document, str(year), str(month), f"engine={ENGINE_VERSION}"]
+    for meta in metas:
+        # movements stored before the sync metadata tracked months, not indexed yet
+        digest = (
+            combine_digests(stored.digest for m, stored in meta.months.items() if m <= until)
+            if meta.months or not meta.content_hash
+            else meta.content_hash
+        )
+        parts.append(f"{meta.market_type}={digest}")
+    return hashlib.blake2b(":".join(parts).encode(), digest_size=16).hexdigest()
@@ -0,0 +1,240 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from b3.normalize import AMOUNT_SCALE, PRICE_SCALE
+
+# movements that are trades; the side is told by the operation type (credit buys, debit sells)
+TRADE_MOVEMENT_TYPES = ("Compra", "Venda", "Compra / Venda", "Transferência - Liquidação")
+# movements columns the engine reads
+INPUT_COLUMNS = (
+    "reference_date",
+    "movement_type",
+    "operation_type",
+    "ticker_symbol",
+    "equities_quantity",
+    "unit_price",
+    "operation_value",
+)
+SWING_RATE: float = 0.15
+DAYTRADE_RATE: float = 0.20
+# monthly swing trade sales up to this amount, in cents, have their gains exempt
+SWING_EXEMPTION: int = 20_000 * AMOUNT_SCALE
+
+MONTHLY_COLUMNS = [
+    "swing_sales",
+    "swing_result",
+    "swing_exempt",
+    "swing_base",
+    "swing_carried_loss",
+    "daytrade_result",
+    "daytrade_base",
+    "daytrade_carried_loss",
+    "tax",
+]
+
+
+def equities_tax(
+    mvmts: pd.DataFrame,
+    until: pd.Period = None,
+    since: pd.Period = None,
+    opening: Optional[dict] = None,
+) -> Tuple[pd.DataFrame, Dict[str, dict]]:
+    """Compute the monthly capital gains tax of equities from the movements history.
+
+    Trades are netted per ticker and day: the quantity both bought and sold on a day is day
+    trade, the rest buys into or sells from the position at its weighted average cost. Swing
+    gains of months with sales up to `SWING_EXEMPTION` are exempt, and losses are carried
+    forward against later gains of the same kind. Everything is computed with cumulative
+    operations over the whole history, no row is visited in Python.
+
+    Sales of more than the known position (bought before the history starts) are costed at
+    the sale price, so they make no gain. Corporate events and withheld taxes are not
+    accounted for.
+
+    :param mvmts: normalized equities movements, as returned by storage, from `since` on
+    :param until: last month to report, months without trades included; the last month traded
+        by default
+    :param since: first month to report; the first month traded by default
+    :param opening: snapshot of the month before `since` to start from, as returned
+    :returns: amounts in cents per month (a monthly PeriodIndex), see `MONTHLY_COLUMNS`, and the
+        month-end snapshot (``YYYY-MM``) of every month reported: the position and total cost
+        per ticker, and the losses carried
+    """
+    daily = _daily_trades(mvmts)
+    if opening and since is not None:
+        daily = _with_opening_positions(daily, opening.get("positions") or {}, since)
+    if daily.empty:
+        first = since if since is not None else until
+        last = until if until is not None else first
+        months = pd.period_range(first, last, freq="M") if first is not None else []
+        monthly = pd.DataFrame(
+            0.0, index=pd.PeriodIndex(months, freq="M"), columns=MONTHLY_COLUMNS
+        )
+    else:
+        daily = _swing_trades(daily)
+        monthly = daily.groupby(daily.reference_date.dt.to_period("M"))[
+            ["swing_sales", "swing_result", "daytrade_result"]
+        ].sum()
+        first = monthly.index.min() if since is None else since
+        last = monthly.index.max() if until is None else max(until, monthly.index.max())
+        monthly = monthly.reindex(pd.period_range(first, last, freq="M"), fill_value=0.0)
+    monthly = _carry_losses(monthly, opening)
+    return monthly, _month_end_snapshots(daily, monthly)
+
+
+def _daily_trades(mvmts: pd.DataFrame) -> pd.DataFrame:
+    """Net the trades per ticker and day, splitting the day trade part out."""
+    if mvmts.empty:
+        return pd.DataFrame()
+    trades = mvmts[mvmts.movement_type.isin(TRADE_MOVEMENT_TYPES)]
+    if trades.empty:
+        return pd.DataFrame()
+    qty = trades.equities_quantity.to_numpy(dtype=float)
+    # trades without a value are valued at their price, rounded to integer cents
+    priced = trades.equities_quantity.astype("Int64") * trades.unit_price.astype("Int64")
+    half, divisor = PRICE_SCALE // AMOUNT_SCALE // 2, PRICE_SCALE // AMOUNT_SCALE
+    value = (
+        trades.operation_value.astype("Int64")
+        .fillna((priced + half) // divisor)
+        .to_numpy(dtype=float, na_value=np.nan)
+    )
+    is_buy = trades.operation_type.astype(str).str.lower().str.startswith("cr").to_numpy()
+    frame = pd.DataFrame(
+        dict(
+            # fractional market tickers (PETR4F) are the same asset as the round lot ones
+            ticker=trades.ticker_symbol.astype(str).str.replace(r"(\d)F$", r"\1", regex=True),
+            reference_date=trades.reference_date.to_numpy(),
+            buy_qty=np.where(is_buy, qty, 0.0),
+            buy_value=np.where(is_buy, value, 0.0),
+            sell_qty=np.where(is_buy, 0.0, qty),
+            sell_value=np.where(is_buy, 0.0, value),
+        )
+    )
+    daily = frame.groupby(["ticker", "reference_date"], sort=True).sum().reset_index()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        daily["buy_price"] = daily.buy_value / daily.buy_qty
+        daily["sell_price"] = daily.sell_value / daily.sell_qty
+    daytrade_qty = np.minimum(daily.buy_qty, daily.sell_qty)
+    daily["daytrade_result"] = (
+        daytrade_qty * (daily.sell_price - daily.buy_price)
+    ).where(daytrade_qty > 0, 0.0)
+    daily["net_qty"] = daily.buy_qty - daily.sell_qty
+    return daily
+
+
+def _swing_trades(daily: pd.DataFrame) -> pd.DataFrame:
+    """Compute the swing trade result of every net sale at the position's average cost.
+
+    The position is the running sum of the net quantities floored at zero; the total cost
+    follows ``C[t] = f[t] * C[t-1] + a[t]``, with ``a`` the cost of a net buy and ``f`` the
+    fraction of the position kept by a net sale. Within a run of an open position this is
+    ``C = F * cumsum(a / F)`` with ``F = cumprod(f)``; a sale closing the position starts a
+    new run.
+    """
+    ticker = daily.ticker
+    net = daily.net_qty
+    running = net.groupby(ticker).cumsum()
+    # position floored at zero, unknown earlier purchases can't be sold short
+    position = running - running.groupby(ticker).cummin().clip(upper=0)
+    previous = position.groupby(ticker).shift(fill_value=0.0)
+    sold = (-net).clip(lower=0)
+    covered = (previous - position).clip(lower=0)
+    bought_cost = (net.clip(lower=0) * daily.buy_price).fillna(0.0)
+
+    closing = (sold > 0) & (position == 0)
+    run = closing.astype(int).groupby(ticker).cumsum() - closing.astype(int)
+    kept = np.where((sold > 0) & (previous > 0) & ~closing, position / previous, 1.0)
+    keys = [ticker, run]
+    kept_product = pd.Series(kept, index=daily.index).groupby(keys).cumprod()
+    cost = kept_product * (bought_cost / kept_product).groupby(keys).cumsum()
+    cost = cost.where(position > 0, 0.0)
+
+    previous_cost = cost.groupby(ticker).shift(fill_value=0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_cost = (previous_cost / previous).where(previous > 0, 0.0)
+    daily["position"] = position
+    daily["cost"] = cost
+    daily["swing_sales"] = (sold * daily.sell_price).fillna(0.0)
+    daily["swing_result"] = (covered * (daily.sell_price - average_cost)).fillna(0.0)
+    return daily
+
+
+def _with_opening_positions(
+    daily: pd.DataFrame, positions: Dict[str, List[float]], since: pd.Period
+) -> pd.DataFrame:
+    """Prepend the opening positions as buys at their total cost, the day before `since`."""
+    if not positions:
+        return daily
+    qty = np.array([p[0] for p in positions.values()], dtype=float)
+    cost = np.array([p[1] for p in positions.values()], dtype=float)
+    opening = pd.DataFrame(
+        dict(
+            ticker=list(positions),
+            reference_date=since.start_time - pd.Timedelta(days=1),
+            buy_qty=qty,
+            buy_value=cost,
+            sell_qty=0.0,
+            sell_value=0.0,
+            buy_price=cost / qty,
+            sell_price=np.nan,
+            daytrade_result=0.0,
+            net_qty=qty,
+        )
+    )
+    daily = pd.concat([opening, daily], ignore_index=True)
+    return daily.sort_values(["ticker", "reference_date"], kind="stable").reset_index(drop=True)
+
+
+def _month_end_snapshots(daily: pd.DataFrame, monthly: pd.DataFrame) -> Dict[str, dict]:
+    """Snapshot the open positions and the carried losses at the end of every month reported."""
+    if monthly.empty:
+        return {}
+    positions = pd.DataFrame(index=monthly.index)
+    costs = pd.DataFrame(index=monthly.index)
+    if not daily.empty:
+        last = daily.assign(month=daily.reference_date.dt.to_period("M"))
+        last = last.groupby(["ticker", "month"]).tail(1)
+        positions = last.pivot(index="month", columns="ticker", values="position")
+        costs = last.pivot(index="month", columns="ticker", values="cost")
+        # positions carry over months without trades of the ticker
+        span = pd.period_range(
+            min(positions.index.min(), monthly.index.min()), monthly.index.max(), freq="M"
+        )
+        positions = positions.reindex(span).ffill().reindex(monthly.index)
+        costs = costs.reindex(span).ffill().reindex(monthly.index)
+    snapshots: Dict[str, dict] = {}
+    for period, row in monthly.iterrows():
+        qty, cost = positions.loc[period], costs.loc[period]
+        held = qty[qty > 0]
+        snapshots[str(period)] = dict(
+            positions={ticker: [float(q), float(cost[ticker])] for ticker, q in held.items()},
+            swing_carried_loss=float(row.swing_carried_loss),
+            daytrade_carried_loss=float(row.daytrade_carried_loss),
+        )
+    return snapshots
+
+
+def _carry_losses(monthly: pd.DataFrame, opening: Optional[dict] = None) -> pd.DataFrame:
+    """Apply the swing exemption, carry losses forward and compute the tax of every month.
+
+    The loss carried after month t is ``L[t] = max(0, L[t-1] - r[t])``: the running sum of the
+    negated results from the opening loss, floored at zero, ``X - min(0, cummin(X))``. The
+    taxable base is what the result exceeds the carried loss by, ``r[t] - L[t-1] + L[t]``.
+    """
+    monthly = monthly.copy()
+    monthly["swing_exempt"] = (monthly.swing_sales <= SWING_EXEMPTION) & (
+        monthly.swing_result > 0
+    )
+    swing = monthly.swing_result.where(~monthly.swing_exempt, 0.0)
+    for kind, result in (("swing", swing), ("daytrade", monthly.daytrade_result)):
+        opening_loss = float((opening or {}).get(f"{kind}_carried_loss", 0.0))
+        losses = opening_loss + (-result).cumsum()
+        carried = losses - losses.cummin().clip(upper=0)
+        monthly[f"{kind}_carried_loss"] = carried
+        monthly[f"{kind}_base"] = result - carried.shift(fill_value=opening_loss) + carried
+    monthly["tax"] = (
+        monthly.swing_base * SWING_RATE + monthly.daytrade_base * DAYTRADE_RATE
+    ).round()
+    return monthly[MONTHLY_COLUMNS]
@@ -0,0 +1,76 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+from config import cfg
+
+from .equities import INPUT_COLUMNS, equities_tax
+
+
+class CalcPool:
+    """Pool of processes running the tax engines off the event loop.
+
+    The engines are CPU bound pandas code: run on the event loop they stall every other
+    request. The movements are sent to the workers as an Arrow IPC buffer of the columns the
+    engine reads only, much smaller and faster to (de)serialize than a pickled frame. With
+    ``workers: 0`` the engines run on the default thread pool instead. Workers are started
+    from a fork server, not forked off the app with its event loop, threads and connections.
+    """
+
+    def __init__(self, workers: int = 2):
+        self._workers: int = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict]) -> "CalcPool":
+        return cls(**(config or {}))
+
+    def start(self) -> None:
+        if self._workers and self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+
+    def stop(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def equities_tax(
+        self,
+        mvmts: pd.DataFrame,
+        until: pd.Period = None,
+        since: pd.Period = None,
+        opening: Optional[dict] = None,
+    ) -> Tuple[pd.DataFrame, Dict[str, dict]]:
+        """Run `equities.equities_tax` on a worker."""
+        payload = to_ipc(mvmts[[c for c in INPUT_COLUMNS if c in mvmts.columns]])
+        return await self._run(_equities_tax, payload, until, since, opening)
+
+    async def _run(self, fn, *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+
+def to_ipc(df: pd.DataFrame) -> bytes:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_ipc(payload: bytes) -> pd.DataFrame:
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+def _equities_tax(
+    payload: bytes, until: pd.Period, since: pd.Period, opening: Optional[dict]
+) -> Tuple[pd.DataFrame, Dict[str, dict]]:
+    return equities_tax(from_ipc(payload), until=until, since=since, opening=opening)
+
+
+calc_pool = CalcPool.from_config(cfg.calc_pool)
@@ -2,9 +2,32 @@ from pydantic import config
 
 from config import cfg
 
+from .base import Storage
 from .firebase import FirebaseDB
+from .sqlite import SQLiteDB
 
-DB_client = FirebaseDB(
-    base_url=cfg.firebase.base_url,
-    auth_token=cfg.firebase.auth_token,
-)
+
+def _create_storage() -> Storage:
+    """Create the storage backend chosen by `storage.backend`."""
+    storage_cfg = cfg.storage or {}
+    storage_kw = dict(
+        max_concurrency=storage_cfg.get("max_concurrency", 4),
+        user_cache=storage_cfg.get("user_cache"),
+        movements_cache=storage_cfg.get("movements_cache"),
+        write_queue=storage_cfg.get("write_queue"),
+        columnar_cache=storage_cfg.get("columnar_cache"),
+        sync_meta_cache=storage_cfg.get("sync_meta_cache"),
+    )
+    backend: str = storage_cfg.get("backend", "firebase")
+    if backend == "sqlite":
+        return SQLiteDB(path=storage_cfg.sqlite.path, **storage_kw)
+    if backend == "firebase":
+        return FirebaseDB(
+            base_url=cfg.firebase.base_url,
+            auth_token=cfg.firebase.auth_token,
+            **storage_kw,
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+DB_client: Storage = _create_storage()
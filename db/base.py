@@ -0,0 +1,538 @@
+import asyncio
+import hashlib
+import json
+import random
+import weakref
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from app.exceptions import DatabaseException
+from app.models import Movements, StoredDigest, SyncMeta, User
+from b3.normalize import normalize_movements
+from config import cfg
+from log import get_logger
+
+from .cache import MovementsCache, TTLCache
+from .columnar import ColumnarCache
+from .writer import WriteBehindQueue
+
+log = get_logger(__name__)
+
+# keys of the sync metadata, of the month-end snapshots and of the day digests among the year
+# keys of a user market
+SYNC_META_KEY = "_meta"
+SNAPSHOTS_KEY = "_snapshots"
+DIGESTS_KEY = "_digests"
+# attempts of an update of the sync metadata conflicting with other workers' ones
+SYNC_META_ATTEMPTS = 8
+
+# changes to apply to the sync metadata read, None to leave it as is
+MetaUpdate = Callable[[SyncMeta], Awaitable[Optional[Dict[str, Any]]]]
+
+
+def wrap_exceptions(fn):
+    """Decorator to log exceptions and raise a DB exception if something bad happened."""
+
+    async def wrapper(*args, **kw):
+        try:
+            return await fn(*args, **kw)
+        except Exception as e:
+            log.exception(f"Exception when executing storage method: {fn.__name__}")
+            raise DatabaseException from e
+
+    return wrapper
+
+
+class Storage(ABC):
+    """Storage interface of the API: users, movements by day and their sync metadata.
+
+    Backends only implement the raw reads and writes. The user and movements caches, the
+    write-behind queue and the per-user read budget are shared by all backends.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        user_cache: Dict = None,
+        movements_cache: Dict = None,
+        write_queue: Dict = None,
+        columnar_cache: Dict = None,
+        sync_meta_cache: Dict = None,
+    ):
+        self._max_concurrency: int = max_concurrency
+        self._user_slots: Dict[str, asyncio.Semaphore] = weakref.WeakValueDictionary()
+        self._users = TTLCache(**(user_cache or {}))
+        self._movements = MovementsCache(**(movements_cache or {}))
+        self._sync_meta = TTLCache(**(sync_meta_cache or {}))
+        self._writer = WriteBehindQueue(write=self._write_movements, **(write_queue or {}))
+        self._columnar: Optional[ColumnarCache] = (
+            ColumnarCache(**columnar_cache) if columnar_cache else None
+        )
+
+    async def start(self) -> None:
+        await self._writer.start()
+
+    async def stop(self) -> None:
+        await self._writer.stop()
+
+    @property
+    def user_cache_stats(self) -> Dict[str, int]:
+        return self._users.stats
+
+    @property
+    def movements_cache_stats(self) -> Dict[str, int]:
+        return self._movements.stats
+
+    @property
+    def write_queue_stats(self) -> Dict[str, Any]:
+        return self._writer.stats
+
+    async def get_user(self, email: str) -> Optional[User]:
+        """Get a user by email, served from the in-process user cache when possible."""
+        return await self._users.get_or_load(email, self._get_user, email)
+
+    @wrap_exceptions
+    async def write_user(self, user: User) -> Optional[str]:
+        try:
+            return await self._write_user(user)
+        finally:
+            self._users.invalidate(user.email)
+
+    @wrap_exceptions
+    async def get_subscribed_users(self) -> List[User]:
+        """Get all users with an active subscription, bypassing the user cache."""
+        return await self._get_subscribed_users()
+
+    @wrap_exceptions
+    async def set_movements(self, movements: List[Movements]):
+        """Queue movements to be stored by day, writing them through to the movements cache.
+
+        The movements are written in the background by the write-behind queue, the digests of
+        their days and the sync metadata of each user market written right away.
+        """
+        self._writer.put({m.path: m.movements for m in movements})
+        written: Dict[Tuple[str, str], List[Movements]] = defaultdict(list)
+        for m in movements:
+            written[(m.document, m.market_type)].append(m)
+        for (document, market_type), days in written.items():
+            previous, meta = await self._update_sync_meta(document, market_type, days)
+            df = normalize_movements(
+                pd.DataFrame.from_records([r for m in days for r in m.movements])
+            )
+            self._movements.write_through(
+                document, market_type, df, meta.content_hash or None, previous.content_hash or None
+            )
+            if self._columnar is not None:
+                await _run_io(
+                    self._columnar.append,
+                    document,
+                    market_type,
+                    df,
+                    meta.content_hash,
+                    previous.content_hash or None,
+                )
+
+    @wrap_exceptions
+    async def get_sync_meta(self, document: str, market_type: str) -> SyncMeta:
+        """Get the sync metadata of a user market, empty if nothing was stored yet."""
+        return await self._sync_meta.get_or_load(
+            (document, market_type), self._load_sync_meta, document, market_type
+        )
+
+    @wrap_exceptions
+    async def mark_synced(self, document: str, market_type: str) -> SyncMeta:
+        """Record a successful sync of a user market from B3."""
+
+        async def synced(meta: SyncMeta) -> Dict[str, Any]:
+            return dict(synced_at=datetime.now())
+
+        _, meta = await self._modify_sync_meta(document, market_type, synced)
+        return meta
+
+    @wrap_exceptions
+    async def mark_active(self, document: str, market_type: str) -> SyncMeta:
+        """Record a request of the user syncing a market, for the scheduler to sync it first."""
+
+        async def active(meta: SyncMeta) -> Dict[str, Any]:
+            return dict(last_active=datetime.now())
+
+        _, meta = await self._modify_sync_meta(document, market_type, active)
+        return meta
+
+    @wrap_exceptions
+    async def get_snapshot(self, document: str, market_type: str, month: str) -> Optional[dict]:
+        """Get the month-end (``YYYY-MM``) snapshot of a user market, if stored."""
+        path = snapshot_path(document, market_type, month)
+        pending = self._writer.pending(prefix=path)
+        if path in pending:
+            return pending[path]
+        return await self._read_snapshot(document, market_type, month)
+
+    @wrap_exceptions
+    async def set_snapshots(
+        self, document: str, market_type: str, snapshots: Dict[str, dict], content_hash: str
+    ) -> None:
+        """Queue month-end snapshots computed from the movements at `content_hash`.
+
+        They only become valid if no movements were written since, as those may change them.
+        """
+        if not snapshots:
+            return
+        until = max(snapshots)
+
+        async def extend(meta: SyncMeta) -> Optional[Dict[str, Any]]:
+            if meta.content_hash != content_hash:
+                return None
+            self._writer.put(
+                {
+                    snapshot_path(document, market_type, month): snapshot
+                    for month, snapshot in snapshots.items()
+                }
+            )
+            if meta.snapshots_until is not None and until <= meta.snapshots_until:
+                return None
+            return dict(snapshots_until=until)
+
+        await self._modify_sync_meta(document, market_type, extend)
+
+    async def _load_sync_meta(self, document: str, market_type: str) -> SyncMeta:
+        stored: Optional[dict] = await self._read_sync_meta(document, market_type)
+        if stored is None:
+            return SyncMeta(document=document, market_type=market_type)
+        return SyncMeta(**stored)
+
+    async def _modify_sync_meta(
+        self, document: str, market_type: str, update: MetaUpdate
+    ) -> Tuple[SyncMeta, SyncMeta]:
+        """Apply an update to the stored sync metadata of a user market.
+
+        The update only applies to the version of the metadata it was computed from: when
+        another worker updated it meanwhile, it's read and the update computed again.
+
+        :returns: the metadata before and after the update
+        """
+        for attempt in range(SYNC_META_ATTEMPTS):
+            meta: SyncMeta = await self._load_sync_meta(document, market_type)
+            changes = await update(meta)
+            if changes is None:
+                updated = meta
+                break
+            updated = meta.copy(update=dict(changes, version=meta.version + 1))
+            if await self._write_sync_meta(
+                document, market_type, json.loads(updated.json()), meta.version
+            ):
+                break
+            await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+        else:
+            raise DatabaseException(
+                f"Conflicting updates of the sync metadata of {document}/{market_type}"
+            )
+        self._sync_meta.set((document, market_type), updated)
+        return meta, updated
+
+    async def index_movements(
+        self, document: str, market_type: str, days: List[Movements]
+    ) -> SyncMeta:
+        """Account for movements stored before the sync metadata tracked them."""
+        if not days:
+            return await self.get_sync_meta(document, market_type)
+        _, meta = await self._update_sync_meta(document, market_type, days)
+        return meta
+
+    async def _update_sync_meta(
+        self, document: str, market_type: str, days: List[Movements]
+    ) -> Tuple[SyncMeta, SyncMeta]:
+        """Account for newly written days in the sync metadata.
+
+        Every stored day keeps a digest of its movements and its row count in a keyspace of
+        their own, replaced when the day is written again. The sync metadata keeps those of
+        every month, combined from its days, and the content hash combines the months, so they
+        only change with the stored content. Snapshots of the months changed and later are no
+        longer valid.
+        """
+        digests: Dict[str, Optional[dict]] = {}
+        for m in days:
+            day = f"{m.year}-{m.month.zfill(2)}-{m.day.zfill(2)}"
+            digests[day] = (
+                dict(digest=day_digest(day, m.movements), rows=len(m.movements))
+                if m.movements
+                else None
+            )
+        # stored right away: the months are combined from the stored digests of their days
+        await self._write_movements(
+            {digest_path(document, market_type, day): d for day, d in digests.items()}
+        )
+        written_months: List[str] = sorted({day[:7] for day in digests})
+        written_last = max((day for day, d in digests.items() if d is not None), default=None)
+
+        async def account(meta: SyncMeta) -> Dict[str, Any]:
+            stored = await asyncio.gather(
+                *(
+                    self._read_day_digests(document, market_type, month)
+                    for month in written_months
+                )
+            )
+            months: Dict[str, StoredDigest] = dict(meta.months)
+            changed: List[str] = []
+            for month, month_days in zip(written_months, stored):
+                combined = StoredDigest(
+                    digest=combine_digests(d["digest"] for d in month_days.values()),
+                    rows=sum(d["rows"] for d in month_days.values()),
+                )
+                if month not in months or months[month].digest != combined.digest:
+                    changed.append(month)
+                if combined.digest:
+                    months[month] = combined
+                else:
+                    months.pop(month, None)
+            snapshots_until = meta.snapshots_until
+            if changed and snapshots_until is not None and snapshots_until >= changed[0]:
+                snapshots_until = str(pd.Period(changed[0], freq="M") - 1)
+            return dict(
+                last_date=max(filter(None, (meta.last_date, written_last)), default=None),
+                rows=sum(stored.rows for stored in months.values()),
+                content_hash=combine_digests(stored.digest for stored in months.values()),
+                snapshots_until=snapshots_until,
+                months=months,
+            )
+
+        return await self._modify_sync_meta(document, market_type, account)
+
+    @wrap_exceptions
+    async def get_movements(
+        self,
+        user: User,
+        start_date: str,
+        end_date: str,
+        market_type: Union[List[str], str] = None,
+    ) -> Dict[str, pd.DataFrame]:
+        """Get movements from database.
+
+        Will return movements from all market types available if no market_type was passed.
+        """
+        if market_type is None:
+            market_type = list(cfg.supported_markets)  # set all market types
+        elif isinstance(market_type, str):
+            market_type = [market_type]
+
+        ret, failures = await self.get_movements_many(
+            user, market_types=market_type, start_date=start_date, end_date=end_date
+        )
+        if failures:
+            raise next(iter(failures.values()))
+        return ret
+
+    async def get_movements_many(
+        self,
+        user: User,
+        market_types: List[str],
+        start_date: str,
+        end_date: str,
+    ) -> Tuple[Dict[str, pd.DataFrame], Dict[str, DatabaseException]]:
+        """Get movements of several market types at once, under the user's read budget.
+
+        :returns: the movements per market type, and the exception per market type that failed
+        """
+        user_slots = self._user_slots.setdefault(
+            user.document, asyncio.Semaphore(self._max_concurrency)
+        )
+        results = await asyncio.gather(
+            *(
+                self._get_market_movements(user, mkt_type, start_date, end_date, user_slots)
+                for mkt_type in market_types
+            ),
+            return_exceptions=True,
+        )
+        ret: Dict[str, pd.DataFrame] = dict()
+        failures: Dict[str, DatabaseException] = dict()
+        for mkt_type, result in zip(market_types, results):
+            if isinstance(result, Exception):
+                failures[mkt_type] = result
+            else:
+                ret[mkt_type] = result
+        return ret, failures
+
+    async def iter_movements(
+        self, user: User, market_type: str, start_date: str, end_date: str
+    ) -> AsyncIterator[pd.DataFrame]:
+        """Yield the movements of the period month by month, oldest first.
+
+        Months not already cached are not added to the caches, and the columnar cache, read
+        whole, is skipped: streaming a long history never holds more than a month of it.
+        """
+        user_slots = self._user_slots.setdefault(
+            user.document, asyncio.Semaphore(self._max_concurrency)
+        )
+        for month in pd.period_range(start_date, end_date, freq="M"):
+            yield await self._get_market_movements(
+                user,
+                market_type,
+                max(start_date, str(month.start_time.date())),
+                min(end_date, str(month.end_time.date())),
+                user_slots,
+                fill_cache=False,
+            )
+
+    @wrap_exceptions
+    async def _get_market_movements(
+        self,
+        user: User,
+        market_type: str,
+        start_date: str,
+        end_date: str,
+        user_slots: asyncio.Semaphore,
+        fill_cache: bool = True,
+    ) -> pd.DataFrame:
+        """Get the movements of the period, from the memory or columnar cache if they cover it.
+
+        Both caches are checked against the content hash of the user market, so movements
+        synced by another worker show up once its sync metadata cache expires. Without
+        ``fill_cache`` the columnar cache is not used, it loads the whole cached history.
+        """
+        meta: SyncMeta = await self.get_sync_meta(user.document, market_type)
+        watermark: Optional[str] = meta.content_hash or None
+        cached = self._movements.get(user.document, market_type, start_date, end_date, watermark)
+        if cached is not None:
+            return cached
+        version: int = self._movements.version
+        if self._columnar is not None and fill_cache:
+            cached = await _run_io(
+                self._columnar.get, user.document, market_type, start_date, end_date, watermark
+            )
+            if cached is not None:
+                self._movements.put(
+                    user.document, market_type, cached, start_date, end_date, version, watermark
+                )
+                return cached
+        stored: Dict[str, List[dict]] = await self._read_movements(
+            user.document, market_type, start_date, end_date, user_slots
+        )
+        # movements still queued for writing override the stored days
+        for path, movements in self._writer.pending(
+            prefix=f"{user.document}/{market_type}/"
+        ).items():
+            if not is_movements_path(path):
+                continue
+            day: str = "-".join(path.split("/")[-3:])
+            if start_date <= day <= end_date:
+                stored[day] = movements
+        records: List[dict] = [m for movements in stored.values() for m in movements]
+        df = normalize_movements(pd.DataFrame.from_records(records))
+        if not fill_cache:
+            return df
+        self._movements.put(
+            user.document, market_type, df, start_date, end_date, version, watermark
+        )
+        if self._columnar is not None and version == self._movements.version:
+            await _run_io(
+                self._columnar.put,
+                user.document,
+                market_type,
+                df,
+                start_date,
+                end_date,
+                watermark,
+            )
+        return df
+
+    @abstractmethod
+    async def _get_user(self, email: str) -> Optional[User]:
+        ...
+
+    @abstractmethod
+    async def _write_user(self, user: User) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def _get_subscribed_users(self) -> List[User]:
+        ...
+
+    @abstractmethod
+    async def _read_movements(
+        self,
+        document: str,
+        market_type: str,
+        start_date: str,
+        end_date: str,
+        user_slots: asyncio.Semaphore,
+    ) -> Dict[str, List[dict]]:
+        """Read the stored movements of the period by day (``YYYY-MM-DD``)."""
+        ...
+
+    @abstractmethod
+    async def _read_sync_meta(self, document: str, market_type: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def _write_sync_meta(
+        self, document: str, market_type: str, meta: dict, version: int
+    ) -> bool:
+        """Store the sync metadata if the stored one is still at `version`, 0 if none is.
+
+        :returns: whether it was stored
+        """
+        ...
+
+    @abstractmethod
+    async def _read_day_digests(
+        self, document: str, market_type: str, month: str
+    ) -> Dict[str, dict]:
+        """Read the stored digests of the days of a month (``YYYY-MM``) by day."""
+        ...
+
+    @abstractmethod
+    async def _read_snapshot(
+        self, document: str, market_type: str, month: str
+    ) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def _write_movements(self, paths: Dict[str, Any]) -> None:
+        """Store movements by day path (``document/market_type/year/month/day``).
+
+        The month-end snapshots of a user market come along at
+        ``document/market_type/_snapshots/YYYY-MM``, and the digests of its days at
+        ``document/market_type/_digests/YYYY-MM-DD``, None to delete one.
+        """
+        ...
+
+
+def sync_meta_path(document: str, market_type: str) -> str:
+    return f"{document}/{market_type}/{SYNC_META_KEY}"
+
+
+def day_digest(day: str, movements: List[dict]) -> str:
+    """Digest of the movements of a day, the same whatever order they are in."""
+    digest = hashlib.blake2b(day.encode(), digest_size=16)
+    for record in sorted(json.dumps(m, sort_keys=True, default=str) for m in movements):
+        digest.update(record.encode() + b"\n")
+    return digest.hexdigest()
+
+
+def combine_digests(digests) -> str:
+    """Combine digests regardless of their order, "" if there are none."""
+    combined = 0
+    for digest in digests:
+        combined ^= int(digest, 16)
+    return f"{combined:032x}" if combined else ""
+
+
+def snapshot_path(document: str, market_type: str, month: str) -> str:
+    return f"{document}/{market_type}/{SNAPSHOTS_KEY}/{month}"
+
+
+def digest_path(document: str, market_type: str, day: str) -> str:
+    return f"{document}/{market_type}/{DIGESTS_KEY}/{day}"
+
+
+def is_movements_path(path: str) -> bool:
+    return path.count("/") == 4
+
+
+async def _run_io(fn, *args):
+    """Run blocking file IO off the event loop."""
+    return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
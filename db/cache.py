@@ -0,0 +1,236 @@
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from b3.normalize import concat_movements
+from utils import SingleFlight
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire ``ttl`` seconds after being set.
+
+    Concurrent misses of the same key are loaded once. ``None`` results are not cached.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self._maxsize: int = maxsize
+        self._ttl: float = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._flight = SingleFlight()
+        self._invalidations: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._invalidations += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._invalidations += 1
+        self._data.clear()
+
+    async def get_or_load(
+        self, key: Hashable, loader: Callable[..., Awaitable[Any]], *args, **kw
+    ) -> Optional[Any]:
+        """Return the cached value, or load it once for all concurrent callers and cache it."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return await self._flight.do(key, self._load, key, loader, *args, **kw)
+
+    async def _load(self, key: Hashable, loader: Callable[..., Awaitable[Any]], *args, **kw):
+        invalidations: int = self._invalidations
+        value = await loader(*args, **kw)
+        # don't cache a value that may have been invalidated while loading
+        if value is not None and invalidations == self._invalidations:
+            self.set(key, value)
+        return value
+
+
+class MovementsCache:
+    """Normalized movements per (document, market type), bounded by a global byte budget.
+
+    Each entry remembers the date range it covers, and any range inside it is sliced straight
+    from the cached frame, kept sorted by reference date. The least recently used entries are
+    evicted once the cached frames exceed ``max_bytes``.
+
+    Entries also remember the watermark (the content hash of the user market) they were read
+    at: read at another one, e.g. after another worker synced the market, they are a miss.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self._max_bytes: int = max_bytes
+        # (document, market_type) -> (start_date, end_date, frame, frame bytes, watermark)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, str, pd.DataFrame, int, Any]]" = (
+            OrderedDict()
+        )
+        self._nbytes: int = 0
+        self._writes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            hits=self.hits, misses=self.misses, size=len(self._entries), bytes=self._nbytes
+        )
+
+    @property
+    def version(self) -> int:
+        """Changes whenever cached movements are written through or invalidated."""
+        return self._writes
+
+    def get(
+        self,
+        document: str,
+        market_type: str,
+        start_date: str,
+        end_date: str,
+        watermark: Optional[str] = None,
+    ) -> Optional[pd.DataFrame]:
+        """Return the movements of the period if the cached entry covers it at the watermark."""
+        entry = self._entries.get((document, market_type))
+        if entry is not None and entry[4] != watermark:
+            self._nbytes -= self._entries.pop((document, market_type))[3]
+            entry = None
+        if entry is None or not (entry[0] <= start_date and end_date <= entry[1]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end((document, market_type))
+        return _slice_sorted(entry[2], start_date, end_date)
+
+    def put(
+        self,
+        document: str,
+        market_type: str,
+        df: pd.DataFrame,
+        start_date: str,
+        end_date: str,
+        version: int = None,
+        watermark: Optional[str] = None,
+    ) -> None:
+        """Cache the movements read for a period, merging with an overlapping entry.
+
+        :param version: the cache `version` when the read started; the read is not cached if
+            movements were written meanwhile, as it may miss them.
+        :param watermark: the content hash of the user market the movements were read at
+        """
+        if version is not None and version != self._writes:
+            return
+        key = (document, market_type)
+        entry = self._entries.get(key)
+        if (
+            entry is not None
+            and entry[4] == watermark
+            and ranges_touch(entry[0], entry[1], start_date, end_date)
+        ):
+            outside: pd.DataFrame = entry[2]
+            if not outside.empty:
+                outside = outside[
+                    (outside.reference_date < start_date) | (outside.reference_date > end_date)
+                ]
+            df = concat_movements([outside, df])
+            start_date, end_date = min(start_date, entry[0]), max(end_date, entry[1])
+        self._store(key, start_date, end_date, df, watermark)
+
+    def write_through(
+        self,
+        document: str,
+        market_type: str,
+        df: pd.DataFrame,
+        watermark: Optional[str] = None,
+        previous_watermark: Optional[str] = None,
+    ) -> None:
+        """Replace the cached days present in the newly written movements.
+
+        :param watermark: the content hash of the user market after the write
+        :param previous_watermark: the one before; an entry cached at another one missed some
+            writes, and is dropped instead.
+        """
+        self._writes += 1
+        key = (document, market_type)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if entry[4] != previous_watermark:
+            self._nbytes -= self._entries.pop(key)[3]
+            return
+        cached: pd.DataFrame = entry[2]
+        if not cached.empty and not df.empty:
+            cached = cached[~cached.reference_date.isin(df.reference_date.unique())]
+        self._store(key, entry[0], entry[1], concat_movements([cached, df]), watermark)
+
+    def invalidate(self, document: str, market_type: str = None) -> None:
+        self._writes += 1
+        for key in [k for k in self._entries if k[0] == document]:
+            if market_type is None or key[1] == market_type:
+                self._nbytes -= self._entries.pop(key)[3]
+
+    def _store(
+        self,
+        key: Tuple[str, str],
+        start_date: str,
+        end_date: str,
+        df: pd.DataFrame,
+        watermark: Optional[str],
+    ) -> None:
+        if not df.empty:
+            df = df.sort_values("reference_date", kind="mergesort")
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[3]
+        if nbytes > self._max_bytes:
+            return
+        self._entries[key] = (start_date, end_date, df, nbytes, watermark)
+        self._nbytes += nbytes
+        while self._nbytes > self._max_bytes:
+            self._nbytes -= self._entries.popitem(last=False)[1][3]
+
+
+def _slice_sorted(df: pd.DataFrame, start_date: str, end_date: str) -> pd.DataFrame:
+    if df.empty:
+        return df
+    dates = df.reference_date.values
+    start = dates.searchsorted(np.datetime64(start_date), side="left")
+    end = dates.searchsorted(np.datetime64(end_date), side="right")
+    return df.iloc[start:end]
+
+
+def ranges_touch(start_a: str, end_a: str, start_b: str, end_b: str) -> bool:
+    """Whether two inclusive date ranges overlap or are adjacent."""
+    one_day = timedelta(days=1)
+    return (
+        date.fromisoformat(start_a) <= date.fromisoformat(end_b) + one_day
+        and date.fromisoformat(start_b) <= date.fromisoformat(end_a) + one_day
+    )
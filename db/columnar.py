@@ -0,0 +1,228 @@
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+from b3.normalize import concat_movements
+from log import get_logger
+
+from .cache import ranges_touch
+
+log = get_logger(__name__)
+
+# bump on any change of the normalized columns, to drop the keys cached before
+FORMAT_VERSION: int = 2
+
+
+class ColumnarCache:
+    """On-disk Arrow IPC cache of the normalized movements per (document, market type).
+
+    Each key is a directory of append-only segment files plus a ``meta.json`` listing them
+    with the date range they cover and the sync watermark they were written at. Segments are
+    memory-mapped on read, so uvicorn workers on the same box share them through the page cache.
+    New days are appended as a new segment and a back-dated write invalidates the key. A key
+    written at another watermark (the content hash of the user market) is a miss, and is
+    replaced by the next read. Segments are compacted into one past ``max_segments``.
+    """
+
+    def __init__(self, path: str, max_segments: int = 8):
+        self._root = Path(path)
+        self._max_segments: int = max_segments
+
+    def get(
+        self,
+        document: str,
+        market_type: str,
+        start_date: str,
+        end_date: str,
+        watermark: Optional[str] = None,
+    ) -> Optional[pd.DataFrame]:
+        """Return the movements of the period if the cached key covers it at the watermark."""
+        key_dir = self._key_dir(document, market_type)
+        meta = self._read_meta(key_dir)
+        if meta is None or not (meta["start"] <= start_date and end_date <= meta["end"]):
+            return None
+        if meta.get("format") != FORMAT_VERSION:
+            return None
+        if watermark is not None and meta.get("watermark") != watermark:
+            return None
+        try:
+            df = self._read_segments(key_dir, meta["segments"])
+        except FileNotFoundError:  # compacted meanwhile by another worker
+            return None
+        if df.empty:
+            return df
+        return df[(df.reference_date >= start_date) & (df.reference_date <= end_date)]
+
+    def put(
+        self,
+        document: str,
+        market_type: str,
+        df: pd.DataFrame,
+        start_date: str,
+        end_date: str,
+        watermark: Optional[str] = None,
+    ) -> None:
+        """Cache the movements read for a period, merged with an overlapping cached range."""
+        key_dir = self._key_dir(document, market_type)
+        with _locked(key_dir):
+            meta = self._read_meta(key_dir)
+            if (
+                meta is not None
+                and meta.get("format") == FORMAT_VERSION
+                and meta.get("watermark") == watermark
+                and ranges_touch(meta["start"], meta["end"], start_date, end_date)
+            ):
+                cached = self._read_segments(key_dir, meta["segments"])
+                if not cached.empty:
+                    cached = cached[
+                        (cached.reference_date < start_date) | (cached.reference_date > end_date)
+                    ]
+                df = concat_movements([cached, df])
+                start_date, end_date = min(start_date, meta["start"]), max(end_date, meta["end"])
+            self._rewrite(key_dir, meta, df, start_date, end_date, watermark)
+
+    def append(
+        self,
+        document: str,
+        market_type: str,
+        df: pd.DataFrame,
+        watermark: Optional[str] = None,
+        previous_watermark: Optional[str] = None,
+    ) -> None:
+        """Append newly synced days; a write of an already cached day invalidates the key.
+
+        :param previous_watermark: the watermark before this write; a key cached at another
+            one missed some writes, and is dropped instead.
+        """
+        if df.empty:
+            return
+        key_dir = self._key_dir(document, market_type)
+        with _locked(key_dir):
+            meta = self._read_meta(key_dir)
+            if meta is None:
+                return
+            if (
+                meta.get("format") != FORMAT_VERSION
+                or meta.get("watermark") != previous_watermark
+            ):
+                shutil.rmtree(key_dir, ignore_errors=True)
+                return
+            first_day = str(df.reference_date.min().date())
+            last_day = str(df.reference_date.max().date())
+            if meta["last_day"] is not None and first_day <= meta["last_day"]:
+                log.info(
+                    "Back-dated movements written, invalidating columnar cache",
+                    extra=dict(document=document, market_type=market_type, day=first_day),
+                )
+                shutil.rmtree(key_dir, ignore_errors=True)
+                return
+            if len(meta["segments"]) >= self._max_segments:
+                cached = self._read_segments(key_dir, meta["segments"])
+                self._rewrite(
+                    key_dir,
+                    meta,
+                    concat_movements([cached, df]),
+                    meta["start"],
+                    max(meta["end"], last_day),
+                    watermark,
+                )
+                return
+            segment = self._write_segment(key_dir, df, meta["next_seq"])
+            self._write_meta(
+                key_dir,
+                dict(
+                    meta,
+                    next_seq=meta["next_seq"] + 1,
+                    end=max(meta["end"], last_day),
+                    last_day=last_day,
+                    watermark=watermark,
+                    segments=meta["segments"] + [segment],
+                ),
+            )
+
+    def invalidate(self, document: str, market_type: str = None) -> None:
+        path = self._root / document
+        if market_type is not None:
+            path = path / market_type
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _key_dir(self, document: str, market_type: str) -> Path:
+        return self._root / document / market_type
+
+    def _rewrite(
+        self,
+        key_dir: Path,
+        meta: Optional[Dict[str, Any]],
+        df: pd.DataFrame,
+        start_date: str,
+        end_date: str,
+        watermark: Optional[str],
+    ) -> None:
+        old_segments: List[str] = meta["segments"] if meta else []
+        seq: int = meta["next_seq"] if meta else 0
+        segment = self._write_segment(key_dir, df, seq)
+        self._write_meta(
+            key_dir,
+            dict(
+                format=FORMAT_VERSION,
+                start=start_date,
+                end=end_date,
+                last_day=str(df.reference_date.max().date()) if not df.empty else None,
+                watermark=watermark,
+                next_seq=seq + 1,
+                segments=[segment],
+            ),
+        )
+        for name in old_segments:
+            # readers holding a mapping of the old segments keep it valid after unlinking
+            (key_dir / name).unlink(missing_ok=True)
+
+    def _write_segment(self, key_dir: Path, df: pd.DataFrame, seq: int) -> str:
+        name = f"seg-{seq:06d}.arrow"
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        tmp = key_dir / f".{name}.tmp"
+        with pa.OSFile(str(tmp), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, key_dir / name)
+        return name
+
+    def _read_segments(self, key_dir: Path, segments: List[str]) -> pd.DataFrame:
+        frames: List[pd.DataFrame] = []
+        for name in segments:
+            # the mapping stays alive as long as the frame's buffers reference it
+            source = pa.memory_map(str(key_dir / name), "r")
+            table = pa.ipc.open_file(source).read_all()
+            frames.append(table.to_pandas(split_blocks=True))
+        return concat_movements(frames)
+
+    def _read_meta(self, key_dir: Path) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads((key_dir / "meta.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, key_dir: Path, meta: Dict[str, Any]) -> None:
+        tmp = key_dir / ".meta.json.tmp"
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, key_dir / "meta.json")
+
+
+@contextmanager
+def _locked(key_dir: Path):
+    """Serialize writers of a key, across processes."""
+    key_dir.mkdir(parents=True, exist_ok=True)
+    with open(key_dir / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
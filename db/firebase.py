@@ -1,22 +1,23 @@
 import asyncio
-from datetime import date
-from typing import Dict, List, Optional, Union
+import json
+import posixpath
+from typing import Any, Dict, List, Optional
 
 import aiohttp
 import pandas as pd
 from aiofirebase import FirebaseHTTP
 
-from app.exceptions import DatabaseException
-from app.models import Movements, User
-from b3 import MARKET_TYPE
+from app.models import User
 from log import get_logger
-from config import cfg
+
+from .base import DIGESTS_KEY, Storage, snapshot_path, sync_meta_path, wrap_exceptions
 
 log = get_logger(__name__)
 
 
-class FirebaseDB(FirebaseHTTP):
-    def __init__(self, base_url: str, auth_token: str, loop=None):
+class FirebaseDB(Storage, FirebaseHTTP):
+    def __init__(self, base_url: str, auth_token: str, loop=None, **storage_kw):
+        Storage.__init__(self, **storage_kw)
         self._base_url: str = base_url
         self._auth_token: str = auth_token
         self._loop = loop or asyncio.get_event_loop()
@@ -32,9 +33,11 @@ class FirebaseDB(FirebaseHTTP):
         return False
 
     async def start(self) -> None:
-        super().__init__(self._base_url, auth=self._auth_token, loop=self._loop)
+        FirebaseHTTP.__init__(self, self._base_url, auth=self._auth_token, loop=self._loop)
+        await Storage.start(self)
 
     async def stop(self) -> None:
+        await Storage.stop(self)
         if self.is_started:
             if not self._sess.closed:
                 await self._sess.close()
@@ -48,22 +51,8 @@ class FirebaseDB(FirebaseHTTP):
             await self.start()
         return await super()._request(*args, **kw)
 
-    def wrap_exceptions(fn):
-        """Decorator to log exceptions and raise a DB exception if something bad happened."""
-
-        async def wrapper(*args, **kw):
-            try:
-                return await fn(*args, **kw)
-            except Exception as e:
-                log.exception(
-                    f"Exception when executing Firebase API method: {fn.__name__}"
-                )
-                raise DatabaseException from e
-
-        return wrapper
-
     @wrap_exceptions
-    async def get_user(self, email: str) -> Optional[User]:
+    async def _get_user(self, email: str) -> Optional[User]:
         params = quote(orderBy="email", equalTo=email)
         resp = await self.get(path="users", params=params)
         if resp:
@@ -71,54 +60,103 @@ class FirebaseDB(FirebaseHTTP):
         else:
             return None
 
-    @wrap_exceptions
-    async def set_movements(self, movements: List[Movements]):
-        mvmts = {m.path: m.movements for m in movements}
-        await self.patch(value=mvmts, path=f"movements")
+    async def _write_user(self, user: User) -> Optional[str]:
+        return await self.put(value=user.dict(), path="users")
 
-    @wrap_exceptions
-    async def get_movements(
+    async def _get_subscribed_users(self) -> List[User]:
+        resp = await self.get(path="users", params=dict(orderBy='"subscription"', equalTo="true"))
+        return [User(**data) for data in (resp or {}).values()]
+
+    async def _read_movements(
         self,
-        user: User,
+        document: str,
+        market_type: str,
         start_date: str,
         end_date: str,
-        market_type: Union[List[str], str] = None,
-    ) -> Dict[str, pd.DataFrame]:
-        """Get movements from database.
-
-        Will return movements from all market types available if no market_type was passed.
-        """
-        resp = await self.get(path=f"movements/{user.document}")
-        print(f"movements from firebase:\n{resp}")
-        if market_type is None:
-            market_type = [m.value for m in cfg.supported_markets]  # set all market types
-        elif isinstance(market_type, str):
-            market_type = [market_type]
-
-        ret: Dict[str, pd.DataFrame] = dict()
-
-        for mkt_type in market_type:
-            df = pd.DataFrame.from_dict(
-                {
-                    (int(yr), int(mo), int(day)): m
-                    for yr in resp.get(mkt_type, {}).keys()
-                    for mo in resp[mkt_type][yr].keys()
-                    for day, movements in resp[mkt_type][yr][mo].items()
-                    for m in movements
-                    if m["reference_date"] >= start_date
-                    and m["reference_date"] <= end_date
-                },
-                orient="index",
+        user_slots: asyncio.Semaphore,
+    ) -> Dict[str, List[dict]]:
+        """Read only the year/month subtrees of the period, one GET per month, concurrently."""
+        months: pd.PeriodIndex = pd.period_range(start_date, end_date, freq="M")
+        responses = await asyncio.gather(
+            *(
+                self._get_month_movements(
+                    path=f"movements/{document}/{market_type}/{mo.year}/{mo.month:02d}",
+                    start_day=start_date[-2:] if idx == 0 else None,
+                    end_day=end_date[-2:] if idx == len(months) - 1 else None,
+                    user_slots=user_slots,
+                )
+                for idx, mo in enumerate(months)
             )
-            df.index.rename(["year", "month", "day"], inplace=True)
-            print(f'df:"\n{df.to_string()}\n')
-            ret[mkt_type] = df
-
-        return ret
-
-    @wrap_exceptions
-    async def write_user(self, user: User) -> Optional[str]:
-        return await self.put(value=user.dict(), path="users")
+        )
+        return {
+            f"{mo.year}-{mo.month:02d}-{day}": movements
+            for mo, resp in zip(months, responses)
+            for day, movements in resp.items()
+        }
+
+    async def _get_month_movements(
+        self,
+        path: str,
+        start_day: Optional[str],
+        end_day: Optional[str],
+        user_slots: asyncio.Semaphore,
+    ) -> Dict[str, List[dict]]:
+        """Get the movements of a month by day, restricted to the day keys in range, if given."""
+        params: Dict[str, str] = dict(orderBy="$key")
+        if start_day:
+            params.update(startAt=start_day)
+        if end_day:
+            params.update(endAt=end_day)
+        async with user_slots:
+            resp = await self.get(
+                path=path, params=quote(**params) if start_day or end_day else None
+            )
+        if isinstance(resp, list):  # Firebase renders mostly numeric keys as arrays
+            resp = {f"{day:02d}": mvmts for day, mvmts in enumerate(resp) if mvmts}
+        return resp or {}
+
+    async def _read_sync_meta(self, document: str, market_type: str) -> Optional[dict]:
+        return await self.get(path=f"movements/{sync_meta_path(document, market_type)}")
+
+    async def _write_sync_meta(
+        self, document: str, market_type: str, meta: dict, version: int
+    ) -> bool:
+        """Compare-and-set through the ETag of the stored record: a Firebase conditional PUT."""
+        url = posixpath.join(self._base_url, "movements", sync_meta_path(document, market_type))
+        url += ".json"
+        params: Dict = dict(auth=self._auth)
+        async with self._sess.get(
+            url, params=params, headers={"X-Firebase-ETag": "true"}
+        ) as resp:
+            resp.raise_for_status()
+            etag: str = resp.headers["ETag"]
+            stored: Optional[dict] = await resp.json()
+        if (stored or {}).get("version", 0) != version:
+            return False
+        async with self._sess.put(
+            url, params=params, data=json.dumps(meta), headers={"if-match": etag}
+        ) as resp:
+            if resp.status == 412:  # written meanwhile
+                return False
+            resp.raise_for_status()
+        return True
+
+    async def _read_day_digests(
+        self, document: str, market_type: str, month: str
+    ) -> Dict[str, dict]:
+        resp = await self.get(
+            path=f"movements/{document}/{market_type}/{DIGESTS_KEY}",
+            params=quote(orderBy="$key", startAt=f"{month}-01", endAt=f"{month}-31"),
+        )
+        return resp or {}
+
+    async def _read_snapshot(
+        self, document: str, market_type: str, month: str
+    ) -> Optional[dict]:
+        return await self.get(path=f"movements/{snapshot_path(document, market_type, month)}")
+
+    async def _write_movements(self, paths: Dict[str, Any]) -> None:
+        await self.patch(value=paths, path="movements")
 
 
 # -------- helpers ------
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.models import User
+from log import get_logger
+
+from .base import DIGESTS_KEY, SNAPSHOTS_KEY, Storage, wrap_exceptions
+
+log = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS movements (
+    document TEXT NOT NULL,
+    market_type TEXT NOT NULL,
+    reference_date TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (document, market_type, reference_date, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync_meta (
+    document TEXT NOT NULL,
+    market_type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (document, market_type)
+);
+CREATE TABLE IF NOT EXISTS day_digests (
+    document TEXT NOT NULL,
+    market_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (document, market_type, day)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    document TEXT NOT NULL,
+    market_type TEXT NOT NULL,
+    month TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (document, market_type, month)
+);
+"""
+
+
+class SQLiteDB(Storage):
+    """Local storage backend on SQLite.
+
+    Movements are clustered by ``(document, market_type, reference_date)``, so a period is read
+    with a single range scan. All queries run on one dedicated thread, off the event loop.
+    """
+
+    def __init__(self, path: str, **storage_kw):
+        super().__init__(**storage_kw)
+        self._path: str = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def is_started(self) -> bool:
+        return self._conn is not None
+
+    async def start(self) -> None:
+        if not self.is_started:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+            await self._run(self._connect)
+        await super().start()
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self.is_started:
+            await self._run(self._conn.close)
+            self._conn = None
+            self._executor.shutdown()
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            await self.start()
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self) -> None:
+        Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    @wrap_exceptions
+    async def _get_user(self, email: str) -> Optional[User]:
+        row = await self._run(
+            lambda: self._conn.execute(
+                "SELECT data FROM users WHERE email = ?", (email,)
+            ).fetchone()
+        )
+        return User.parse_raw(row[0]) if row else None
+
+    async def _write_user(self, user: User) -> Optional[str]:
+        def write():
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO users (email, data) VALUES (?, ?)",
+                    (user.email, user.json()),
+                )
+
+        await self._run(write)
+        return user.email
+
+    async def _get_subscribed_users(self) -> List[User]:
+        rows = await self._run(
+            lambda: self._conn.execute(
+                "SELECT data FROM users WHERE json_extract(data, '$.subscription') = 1"
+            ).fetchall()
+        )
+        return [User.parse_raw(data) for data, in rows]
+
+    async def _read_movements(
+        self,
+        document: str,
+        market_type: str,
+        start_date: str,
+        end_date: str,
+        user_slots: asyncio.Semaphore,
+    ) -> Dict[str, List[dict]]:
+        async with user_slots:
+            rows = await self._run(
+                lambda: self._conn.execute(
+                    "SELECT reference_date, data FROM movements"
+                    " WHERE document = ? AND market_type = ?"
+                    " AND reference_date BETWEEN ? AND ?"
+                    " ORDER BY reference_date, seq",
+                    (document, market_type, start_date, end_date),
+                ).fetchall()
+            )
+        stored: Dict[str, List[dict]] = defaultdict(list)
+        for day, data in rows:
+            stored[day].append(json.loads(data))
+        return stored
+
+    async def _read_sync_meta(self, document: str, market_type: str) -> Optional[dict]:
+        row = await self._run(
+            lambda: self._conn.execute(
+                "SELECT data FROM sync_meta WHERE document = ? AND market_type = ?",
+                (document, market_type),
+            ).fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    async def _write_sync_meta(
+        self, document: str, market_type: str, meta: dict, version: int
+    ) -> bool:
+        def write() -> bool:
+            with self._conn:
+                updated = self._conn.execute(
+                    "UPDATE sync_meta SET data = ? WHERE document = ? AND market_type = ?"
+                    " AND COALESCE(json_extract(data, '$.version'), 0) = ?",
+                    (json.dumps(meta), document, market_type, version),
+                ).rowcount
+                if not updated and version == 0:
+                    updated = self._conn.execute(
+                        "INSERT OR IGNORE INTO sync_meta (document, market_type, data)"
+                        " VALUES (?, ?, ?)",
+                        (document, market_type, json.dumps(meta)),
+                    ).rowcount
+            return bool(updated)
+
+        return await self._run(write)
+
+    async def _read_day_digests(
+        self, document: str, market_type: str, month: str
+    ) -> Dict[str, dict]:
+        rows = await self._run(
+            lambda: self._conn.execute(
+                "SELECT day, data FROM day_digests WHERE document = ? AND market_type = ?"
+                " AND day BETWEEN ? AND ?",
+                (document, market_type, f"{month}-01", f"{month}-31"),
+            ).fetchall()
+        )
+        return {day: json.loads(data) for day, data in rows}
+
+    async def _read_snapshot(
+        self, document: str, market_type: str, month: str
+    ) -> Optional[dict]:
+        row = await self._run(
+            lambda: self._conn.execute(
+                "SELECT data FROM snapshots WHERE document = ? AND market_type = ? AND month = ?",
+                (document, market_type, month),
+            ).fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    async def _write_movements(self, paths: Dict[str, Any]) -> None:
+        """Replace the movements of every day path in a single transaction."""
+
+        def write():
+            with self._conn:
+                for path, movements in paths.items():
+                    if f"/{DIGESTS_KEY}/" in path:
+                        document, market_type, _, day = path.split("/")
+                        if movements is None:
+                            self._conn.execute(
+                                "DELETE FROM day_digests WHERE document = ? AND market_type = ?"
+                                " AND day = ?",
+                                (document, market_type, day),
+                            )
+                        else:
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO day_digests"
+                                " (document, market_type, day, data) VALUES (?, ?, ?, ?)",
+                                (document, market_type, day, json.dumps(movements)),
+                            )
+                        continue
+                    if f"/{SNAPSHOTS_KEY}/" in path:
+                        document, market_type, _, month = path.split("/")
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO snapshots (document, market_type, month, data)"
+                            " VALUES (?, ?, ?, ?)",
+                            (document, market_type, month, json.dumps(movements)),
+                        )
+                        continue
+                    document, market_type, year, month, day = path.split("/")
+                    reference_date = f"{year}-{month}-{day}"
+                    self._conn.execute(
+                        "DELETE FROM movements WHERE document = ? AND market_type = ?"
+                        " AND reference_date = ?",
+                        (document, market_type, reference_date),
+                    )
+                    self._conn.executemany(
+                        "INSERT INTO movements"
+                        " (document, market_type, reference_date, seq, data)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (document, market_type, reference_date, seq, json.dumps(m))
+                            for seq, m in enumerate(movements)
+                        ],
+                    )
+
+        await self._run(write)
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from log import get_logger
+
+log = get_logger(__name__)
+
+
+class WriteBehindQueue:
+    """Write movements to storage in the background instead of on the request path.
+
+    Pending writes are coalesced per user and per day path, the last write of a path winning,
+    and flushed as multi-path updates of at most ``max_batch_bytes`` of JSON each. Failed
+    batches are retried with exponential backoff and put back in the queue if they still fail.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[Dict[str, Any]], Awaitable[Any]],
+        max_batch_bytes: int = 1024 * 1024,
+        flush_interval: float = 0.5,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self._write = write
+        self._max_batch_bytes: int = max_batch_bytes
+        self._flush_interval: float = flush_interval
+        self._max_retries: int = max_retries
+        self._retry_delay: float = retry_delay
+        # document -> day path -> movements
+        self._pending: Dict[str, Dict[str, List[dict]]] = defaultdict(dict)
+        self._writing: Dict[str, Dict[str, List[dict]]] = {}
+        self._enqueued_at: Dict[str, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._last_flush_latency: float = 0.0
+        self.flushed: int = 0
+        self.failed: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of day paths waiting to be written."""
+        return sum(len(paths) for paths in self._pending.values())
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            queue_depth=self.queue_depth,
+            last_flush_latency=self._last_flush_latency,
+            flushed=self.flushed,
+            failed=self.failed,
+        )
+
+    def put(self, paths: Dict[str, List[dict]]) -> None:
+        """Queue movements by day path (``document/market_type/year/month/day``)."""
+        now = time.monotonic()
+        for path, movements in paths.items():
+            document = path.split("/", 1)[0]
+            self._pending[document][path] = movements
+            self._enqueued_at.setdefault(document, now)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self, prefix: str) -> Dict[str, List[dict]]:
+        """Return the queued movements whose path starts with `prefix`, to read our own writes."""
+        document = prefix.split("/", 1)[0]
+        paths = {**self._writing.get(document, {}), **self._pending.get(document, {})}
+        return {
+            path: movements for path, movements in paths.items() if path.startswith(prefix)
+        }
+
+    async def start(self) -> None:
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """Stop the worker and flush everything still queued."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        if self._pending:
+            log.error(
+                "Dropping movements that could not be written on shutdown",
+                extra=dict(queue_depth=self.queue_depth),
+            )
+
+    async def flush(self) -> None:
+        """Write everything queued so far, one user at a time."""
+        for document in list(self._pending):
+            paths = self._writing[document] = self._pending.pop(document)
+            enqueued_at = self._enqueued_at.pop(document, time.monotonic())
+            remaining: Dict[str, List[dict]] = dict(paths)
+            try:
+                for batch in self._batches(paths):
+                    if not await self._write_batch(batch):
+                        self._requeue(document, batch, enqueued_at)
+                    for path in batch:
+                        remaining.pop(path)
+            except asyncio.CancelledError:
+                # stopped while writing, keep what was not written for the final flush
+                self._requeue(document, remaining, enqueued_at)
+                raise
+            finally:
+                self._writing.pop(document, None)
+            self._last_flush_latency = time.monotonic() - enqueued_at
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # let writes of the same burst coalesce before flushing
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Got an exception when flushing movements")
+
+    def _batches(self, paths: Dict[str, List[dict]]):
+        batch: Dict[str, List[dict]] = {}
+        batch_bytes: int = 0
+        for path, movements in paths.items():
+            size = len(path) + len(json.dumps(movements, default=str))
+            if batch and batch_bytes + size > self._max_batch_bytes:
+                yield batch
+                batch, batch_bytes = {}, 0
+            batch[path] = movements
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    async def _write_batch(self, batch: Dict[str, List[dict]]) -> bool:
+        for attempt in range(self._max_retries + 1):
+            try:
+                await self._write(batch)
+                self.flushed += len(batch)
+                return True
+            except Exception:
+                log.exception(
+                    "Failed to write movements batch",
+                    extra=dict(attempt=attempt + 1, paths=len(batch)),
+                )
+                if attempt < self._max_retries:
+                    await asyncio.sleep(self._retry_delay * 2 ** attempt)
+        self.failed += len(batch)
+        return False
+
+    def _requeue(self, document: str, batch: Dict[str, List[dict]], enqueued_at: float) -> None:
+        pending = self._pending[document]
+        for path, movements in batch.items():
+            # a newer write of the same path supersedes the failed one
+            pending.setdefault(path, movements)
+        self._enqueued_at[document] = min(
+            enqueued_at, self._enqueued_at.get(document, enqueued_at)
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
@@ -0,0 +1,118 @@
+import pandas as pd
+import pytest
+
+from b3.normalize import normalize_movements
+from calc.equities import equities_tax
+
+
+def movements(*trades) -> pd.DataFrame:
+    """Normalized equities movements of (date, side, ticker, quantity, price) trades."""
+    return normalize_movements(
+        pd.DataFrame(
+            [
+                dict(
+                    reference_date=day,
+                    movement_type="Compra" if side == "buy" else "Venda",
+                    operation_type="Credito" if side == "buy" else "Debito",
+                    ticker_symbol=ticker,
+                    equities_quantity=qty,
+                    unit_price=price,
+                    operation_value=qty * price,
+                )
+                for day, side, ticker, qty, price in trades
+            ]
+        )
+    )
+
+
+def test_sale_is_costed_at_the_weighted_average_cost():
+    monthly, snapshots = equities_tax(
+        movements(
+            ("2022-01-03", "buy", "PETR4", 1000, 10),
+            ("2022-01-10", "buy", "PETR4", 1000, 20),
+            ("2022-02-07", "sell", "PETR4", 1000, 30),
+        )
+    )
+
+    feb = monthly.loc[pd.Period("2022-02")]
+    assert feb.swing_sales == 3_000_000
+    assert feb.swing_result == 1_500_000
+    assert not feb.swing_exempt
+    assert feb.tax == 225_000
+    assert monthly.loc[pd.Period("2022-01")].tax == 0
+    assert snapshots["2022-02"]["positions"] == {"PETR4": [1000.0, 1_500_000.0]}
+
+
+def test_small_monthly_sales_are_exempt():
+    monthly, _ = equities_tax(
+        movements(
+            ("2022-01-03", "buy", "PETR4", 100, 10),
+            ("2022-01-10", "sell", "PETR4", 100, 30),
+        )
+    )
+
+    jan = monthly.loc[pd.Period("2022-01")]
+    assert jan.swing_result == 200_000
+    assert jan.swing_exempt
+    assert jan.swing_base == 0
+    assert jan.tax == 0
+
+
+def test_same_day_buy_and_sale_is_day_trade():
+    monthly, snapshots = equities_tax(
+        movements(
+            ("2022-01-03", "buy", "VALE3", 100, 10),
+            ("2022-01-03", "sell", "VALE3", 100, 12),
+        )
+    )
+
+    jan = monthly.loc[pd.Period("2022-01")]
+    assert jan.daytrade_result == 20_000
+    assert jan.swing_sales == 0
+    assert jan.swing_result == 0
+    assert jan.tax == 4_000
+    assert snapshots["2022-01"]["positions"] == {}
+
+
+def test_losses_are_carried_against_later_gains():
+    monthly, snapshots = equities_tax(
+        movements(
+            ("2022-01-03", "buy", "PETR4", 2000, 10),
+            ("2022-01-10", "sell", "PETR4", 2000, 8),
+            ("2022-03-03", "buy", "PETR4", 1000, 10),
+            ("2022-03-10", "sell", "PETR4", 1000, 25),
+        )
+    )
+
+    assert monthly.swing_carried_loss.tolist() == [400_000, 400_000, 0]
+    assert snapshots["2022-02"]["swing_carried_loss"] == 400_000
+    mar = monthly.loc[pd.Period("2022-03")]
+    assert mar.swing_result == 1_500_000
+    assert mar.swing_base == 1_100_000
+    assert mar.tax == 165_000
+
+
+@pytest.mark.parametrize("since", ["2022-02", "2022-03"])
+def test_resuming_from_a_snapshot_matches_the_full_history(since):
+    trades = [
+        ("2022-01-03", "buy", "PETR4", 2000, 10),
+        ("2022-01-10", "sell", "PETR4", 1000, 8),
+        ("2022-01-12", "buy", "VALE3", 300, 70),
+        ("2022-02-07", "buy", "PETR4", 1000, 14),
+        ("2022-02-08", "buy", "VALE3", 100, 60),
+        ("2022-02-08", "sell", "VALE3", 100, 65),
+        ("2022-03-15", "sell", "PETR4", 2000, 15),
+        ("2022-03-16", "sell", "VALE3", 150, 80),
+    ]
+    full, full_snapshots = equities_tax(movements(*trades))
+    opening = full_snapshots[str(pd.Period(since) - 1)]
+
+    resumed, snapshots = equities_tax(
+        movements(*(t for t in trades if t[0] >= since)),
+        since=pd.Period(since),
+        opening=opening,
+    )
+
+    pd.testing.assert_frame_equal(resumed, full.loc[since:])
+    assert snapshots == {m: s for m, s in full_snapshots.items() if m >= since}
+    assert full.loc[pd.Period("2022-03")].tax == resumed.loc[pd.Period("2022-03")].tax > 0
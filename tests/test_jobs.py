@@ -0,0 +1,88 @@
+import json
+import subprocess
+import sys
+import uuid
+from datetime import datetime
+
+import pytest
+
+from app.jobs import DarfJobs
+from app.models import DarfJob
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    jobs = DarfJobs(path=str(tmp_path / "darf-jobs.sqlite"))
+    jobs._connect()
+    yield jobs
+    jobs._conn.close()
+
+
+def new_job() -> DarfJob:
+    return DarfJob(
+        id=uuid.uuid4().hex,
+        document="04781722903",
+        year=2022,
+        month=3,
+        markets=["equities"],
+        status="queued",
+        created_at=datetime.now(),
+    )
+
+
+KEY = json.dumps(["04781722903", ["equities"], 2022, 3, "hash"])
+
+
+def test_job_of_the_same_key_is_returned_instead_of_stored(jobs):
+    job = new_job()
+
+    assert jobs._insert(KEY, job) is None
+    found = jobs._insert(KEY, new_job())
+
+    assert found is not None and found.id == job.id
+    assert jobs._select(job.id).status == "queued"
+
+
+def test_jobs_of_other_keys_are_stored(jobs):
+    job = new_job()
+    jobs._insert(KEY, job)
+
+    other = new_job()
+    assert jobs._insert(KEY.replace("hash", "new movements"), other) is None
+    assert jobs._select(other.id) is not None
+
+
+def test_done_job_is_returned(jobs):
+    job = new_job()
+    jobs._insert(KEY, job)
+    job.status, job.finished_at = "done", datetime.now()
+    jobs._update(job)
+
+    assert jobs._insert(KEY, new_job()).id == job.id
+
+
+def test_failed_job_is_replaced(jobs):
+    job = new_job()
+    jobs._insert(KEY, job)
+    job.status, job.finished_at, job.error = "failed", datetime.now(), "boom"
+    jobs._update(job)
+
+    retry = new_job()
+    assert jobs._insert(KEY, retry) is None
+    assert jobs._insert(KEY, new_job()).id == retry.id
+    assert jobs._select(job.id).status == "failed"
+
+
+def test_job_of_a_stopped_worker_is_failed_and_replaced(jobs):
+    job = new_job()
+    jobs._insert(KEY, job)
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    jobs._conn.execute("UPDATE darf_jobs SET owner = ? WHERE id = ?", (gone.pid, job.id))
+
+    stopped = jobs._select(job.id)
+    assert stopped.status == "failed"
+    assert stopped.error == "the worker running the job stopped"
+    retry = new_job()
+    assert jobs._insert(KEY, retry) is None
+    assert jobs._select(job.id).finished_at is not None
@@ -0,0 +1,140 @@
+import asyncio
+
+import orjson
+import pandas as pd
+import pytest
+
+from app import sync
+from app.api.routers import b3_router
+from app.exceptions import DatabaseException
+from app.models import SyncMeta, User
+from b3.normalize import normalize_movements
+from db import DB_client
+
+USER = User(document="04781722903", name="Ana", password="secret", email="ana@example.com")
+
+
+def movements(*days: str) -> pd.DataFrame:
+    return normalize_movements(
+        pd.DataFrame(
+            [
+                dict(
+                    reference_date=day,
+                    movement_type="Compra",
+                    operation_type="Credito",
+                    ticker_symbol="PETR4",
+                    equities_quantity=15,
+                    unit_price="7.90",
+                    operation_value="118.50",
+                )
+                for day in days
+            ]
+        )
+    )
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Stored movements of the user, counting the times they are read."""
+    state = dict(content_hash="first", reads=0)
+
+    async def sync_markets(user, markets, background=False):
+        return {}
+
+    async def get_sync_meta(document, market_type):
+        return SyncMeta(
+            document=document, market_type=market_type, content_hash=state["content_hash"]
+        )
+
+    async def get_movements(user, market_type, start_date, end_date, sync=True):
+        state["reads"] += 1
+        return movements("2022-01-03")
+
+    monkeypatch.setattr(sync, "sync_markets", sync_markets)
+    monkeypatch.setattr(DB_client, "get_sync_meta", get_sync_meta)
+    monkeypatch.setattr(sync, "get_movements", get_movements)
+    return state
+
+
+def get_movements(**kw):
+    params = dict(
+        user=USER,
+        market_type="equities",
+        start_date=None,
+        end_date=None,
+        stream=False,
+        accept=None,
+        if_none_match=None,
+        allow_stale=False,
+    )
+    return asyncio.run(b3_router.get_movements(**{**params, **kw}))
+
+
+def read_body(response) -> bytes:
+    async def read():
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    return asyncio.run(read())
+
+
+def test_movements_are_not_read_again_when_not_modified(stored):
+    response = get_movements()
+    etag = response.headers["etag"]
+
+    assert response.status_code == 200
+    assert orjson.loads(response.body)["movements"]["2022"]["01"]["03"][0]["unit_price"] == "7.90"
+    assert stored["reads"] == 1
+
+    not_modified = get_movements(if_none_match=etag)
+
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+    assert not not_modified.body
+    assert stored["reads"] == 1
+
+
+def test_movements_are_read_again_once_synced_movements_change(stored):
+    etag = get_movements().headers["etag"]
+    stored["content_hash"] = "second"
+
+    response = get_movements(if_none_match=etag)
+
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert stored["reads"] == 2
+
+
+@pytest.mark.parametrize(
+    "kw", [dict(stream=True), dict(accept="application/x-ndjson, application/json")]
+)
+def test_movements_are_streamed_as_ndjson_one_line_per_day(monkeypatch, kw):
+    async def iter_movements(user, market_type, start_date, end_date):
+        yield movements("2022-01-03", "2022-01-03", "2022-01-04")
+        yield movements("2022-02-01")
+
+    monkeypatch.setattr(sync, "iter_movements", iter_movements)
+
+    response = get_movements(**kw)
+
+    assert response.media_type == "application/x-ndjson"
+    lines = [orjson.loads(line) for line in read_body(response).splitlines()]
+    assert [(line["year"], line["month"], line["day"]) for line in lines] == [
+        ("2022", "01", "03"),
+        ("2022", "01", "04"),
+        ("2022", "02", "01"),
+    ]
+    assert [len(line["movements"]) for line in lines] == [2, 1, 1]
+    assert all(line["document"] == USER.document for line in lines)
+
+
+def test_stream_failing_midway_ends_with_a_message(monkeypatch):
+    async def iter_movements(user, market_type, start_date, end_date):
+        yield movements("2022-01-03")
+        raise DatabaseException("unreachable")
+
+    monkeypatch.setattr(sync, "iter_movements", iter_movements)
+
+    lines = read_body(get_movements(stream=True)).splitlines()
+
+    assert len(lines) == 2
+    assert orjson.loads(lines[-1]) == dict(msg="Failed to retrieve movements")
@@ -0,0 +1,81 @@
+import pandas as pd
+
+from app.sync import df_to_movements_dict, dict_to_movements_list
+from b3.normalize import normalize_movements
+
+RECORDS = [
+    dict(
+        reference_date="2022-02-07",
+        product_category="Renda Variável",
+        product_type_name="Ações",
+        movement_type="Venda",
+        operation_type="Debito",
+        ticker_symbol="PETR4",
+        corporation_name="PETROBRAS",
+        participant_name="CORRETORA",
+        participant_document_number="88888888888",
+        equities_quantity=10,
+        unit_price="12.3456",
+        operation_value="123.46",
+    ),
+    dict(
+        reference_date="2022-01-03",
+        product_category="Renda Variável",
+        product_type_name="Ações",
+        movement_type="Compra",
+        operation_type="Credito",
+        ticker_symbol="PETR4",
+        corporation_name="PETROBRAS",
+        participant_name="CORRETORA",
+        participant_document_number="88888888888",
+        equities_quantity=15,
+        unit_price="7.90",
+        operation_value="118.50",
+    ),
+    dict(
+        reference_date="2022-01-03",
+        product_category="Renda Variável",
+        product_type_name="Ações",
+        movement_type="Compra",
+        operation_type="Credito",
+        ticker_symbol="VALE3",
+        corporation_name="VALE",
+        participant_name="CORRETORA",
+        participant_document_number="88888888888",
+        equities_quantity=1,
+        unit_price="0.00000001",
+        operation_value=None,
+    ),
+]
+
+
+def test_movements_dict_groups_wire_records_by_day():
+    grouped = df_to_movements_dict(normalize_movements(pd.DataFrame(RECORDS)))
+
+    assert list(grouped) == ["2022"]
+    assert list(grouped["2022"]) == ["01", "02"]
+    assert list(grouped["2022"]["01"]) == ["03"]
+    # movements of a day keep their order
+    assert grouped["2022"]["01"]["03"] == [RECORDS[1], RECORDS[2]]
+    assert grouped["2022"]["02"]["07"] == [RECORDS[0]]
+
+
+def test_movements_dict_round_trips_through_storage():
+    df = normalize_movements(pd.DataFrame(RECORDS))
+
+    stored = dict_to_movements_list("04781722903", "equities", df_to_movements_dict(df))
+    loaded = normalize_movements(
+        pd.DataFrame([m for day in stored for m in day.movements])
+    )
+
+    assert [(d.year, d.month, d.day) for d in stored] == [
+        ("2022", "01", "03"),
+        ("2022", "02", "07"),
+    ]
+    pd.testing.assert_frame_equal(
+        loaded, df.sort_values("reference_date", kind="stable"), check_categorical=False
+    )
+
+
+def test_movements_dict_of_no_movements_is_empty():
+    assert df_to_movements_dict(pd.DataFrame()) == {}
@@ -0,0 +1,93 @@
+import time
+
+from b3.throttle import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def open_breaker(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    for _ in range(2):
+        breaker.record(breaker.allow(), False)
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker, clock
+
+
+def test_circuit_opens_after_consecutive_failures(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+
+    assert breaker.allow() is None
+    assert breaker.retry_after == 30
+    clock.now += 10
+    assert breaker.retry_after == 20
+
+
+def test_half_open_lets_a_single_probe_through(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    probe = breaker.allow()
+    assert probe is not None and probe.probe
+    assert breaker.allow() is None
+
+
+def test_probe_success_closes_the_circuit(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+
+    breaker.record(breaker.allow(), True)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() is not None
+    # failures are counted from zero again
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_probe_failure_opens_the_circuit_again(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+
+    breaker.record(breaker.allow(), False)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_after == 30
+
+
+def test_cancelled_probe_lets_another_one_through(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+
+    breaker.record(breaker.allow(), None)
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow().probe
+
+
+def test_outcome_of_a_call_let_through_before_the_circuit_opened_is_ignored(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    stale = breaker.allow()
+    for _ in range(2):
+        breaker.record(breaker.allow(), False)
+
+    breaker.record(stale, True)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 30
+    probe = breaker.allow()
+    breaker.record(probe, True)
+    # nor after it closed again
+    breaker.record(stale, False)
+    breaker.record(stale, False)
+    assert breaker.state == CircuitBreaker.CLOSED
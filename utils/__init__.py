@@ -0,0 +1 @@
+from .utils import SingleFlight
@@ -0,0 +1,37 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls sharing the same key.
+
+    The first caller for a key starts the call, every caller arriving while it is in flight
+    awaits the same result (or exception). Cancelling one waiter does not cancel the call.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def in_flight(self, key: Hashable) -> Optional[asyncio.Future]:
+        """Return the in-flight call for the key, if any."""
+        return self._calls.get(key)
+
+    def keys(self):
+        return self._calls.keys()
+
+    def start(
+        self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kw
+    ) -> asyncio.Future:
+        """Start the call for the key unless it is in flight already, and return it."""
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn(*args, **kw))
+            self._calls[key] = fut
+            fut.add_done_callback(lambda _: self._calls.pop(key, None))
+        return fut
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kw) -> Any:
+        return await asyncio.shield(self.start(key, fn, *args, **kw))